@@ -30,7 +30,13 @@ helpmsg ="""
 Appie is a minimal python static site generator. Just read the source!
 
 -h      This help message
+-v      Verbose, log what happens to every file
+-q      Quiet, only log warnings and errors
 -f      Rebuild the site from scratch (rm -rf _site dir before run)
+-j N    Parse files using N worker processes (default: number of CPUs)
+-s      Build into a staging dir and swap it with the _site dir when done
+--profile   Write a report of where the build time goes to appie-profile.json
+--cprofile  Like --profile and write cProfile stats to appie-profile.prof
 """
 
 import os
@@ -39,68 +45,793 @@ import re
 import sys
 import json
 import datetime
+import time
+import contextlib
+import functools
+import logging
+import hashlib
+import sqlite3
+import heapq
+import collections
 import markdown
+from xml.sax.saxutils import escape as xml_escape
+from markdown.extensions.codehilite import CodeHilite, CodeHiliteExtension, HiliteTreeprocessor
+from markdown.extensions.meta import META_RE, META_MORE_RE, BEGIN_RE, END_RE
+from markdown.treeprocessors import Treeprocessor
+from markdown.util import HTML_PLACEHOLDER_RE
 from PIL import Image
-# A very simple plugin system. Just create a plugins.py file
-# with the match_dir and match_file function. If the file doesn't
-# exist we create an empty plugin as a class
-if os.path.isfile("plugins.py") and __name__ == "__main__":
-    import plugins
-else:
-    class plugins:
-        def match_dir(*args, **kwargs):
-            pass
-        def match_file(*args, **kwargs):
-            pass
+
+# a summary of the build is logged at info level, every file at debug level
+logger = logging.getLogger("appie")
+# A very simple plugin system. Just create a plugins.py file with a
+# function for every stage of the build you want to hook into, see
+# load_plugins. The hooks of the loaded plugins by stage:
+PLUGIN_STAGES = ("pre_walk", "match_dir", "transform", "post_render", "post_build")
+_hooks = {}
 
 # Load jinja templates
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, meta as jinja_meta
 # Create a Jinja2 environment and specify the template directory
 env = Environment(loader=FileSystemLoader('./templates'))
 
+# templates resolved during this build, see find_template
+_found_templates = {}
+# the build state passed to the templates which isn't in the params hash
+STATE_NAMES = ("_tags", "_latest")
+# the build state a template uses, see template_state
+_state_templates = {}
+
+def find_template(*names):
+    """
+    Return the first existing template of the names. The result is 
+    remembered during the build, call reset_templates for a new build.
+    """
+    tpl = _found_templates.get(names)
+    if tpl is None:
+        tpl = env.select_template(names)
+        if tpl.name != names[-1]:
+            logger.debug("using the {} template".format(tpl.name))
+        _found_templates[names] = tpl
+    return tpl
+
+def reset_templates(**params):
+    """
+    Start a new build: forget the resolved templates and store compiled
+    templates in the cache dir so they don't need to be compiled every run
+    """
+    _found_templates.clear()
+    _state_templates.clear()
+    path = os.path.join(params.get("cache_path", ".appie-cache"), "jinja")
+    os.makedirs(path, exist_ok=True)
+    env.bytecode_cache = FileSystemBytecodeCache(path)
+
+# The build manifest is saved in the output dir. It records what every
+# generated page was made from so unchanged pages can be skipped
+MANIFEST_NAME = ".appie-manifest"
+MANIFEST_VERSION = 8
+# What we know of every source file, the sources, images and meta sections 
+# of the manifest, is kept in a sqlite db in the cache dir, see MetaStore
+METADB_NAME = "meta.sqlite"
+METADB_SECTIONS = ("sources", "images", "meta")
+# params which change how we build, not what we build
+BUILD_OPTIONS = ("jobs", "cache_path", "highlight_cache_size", "static_links", "stage",
+                 "output_path", "compress", "asset_links", "markdown_cache_size",
+                 "image_cache_size", "minify_cache_size")
+
+# Outputs we write compressed siblings of if 'compress' is set in params.json,
+# e.g. for nginx's gzip_static and brotli_static
+COMPRESS_EXTENSIONS = (".html", ".css", ".js", ".xml", ".svg")
+COMPRESS_FORMATS = {"gzip": ".gz", "br": ".br"}
+
+# Elements whose content we keep as is when minifying html, i.e. the
+# <pre> blocks of code highlighted by codehilite
+MINIFY_KEEP_RE = re.compile(r"<(pre|textarea|script|style)\b.*?</\1\s*>", re.S | re.I)
+# Tags around which whitespace doesn't matter because they're blocks
+MINIFY_BLOCK_RE = re.compile(r"\s*(</?(?:html|head|body|meta|link|title|nav|main|section|"
+                             r"article|aside|header|footer|div|p|h[1-6]|ul|ol|li|dl|dt|dd|"
+                             r"table|thead|tbody|tr|th|td|figure|figcaption|br|hr)\b[^>]*>)\s*", re.I)
+# Quoted strings and comments of css, strings are kept as is when minifying
+MINIFY_CSS_RE = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/""", re.S)
+# Minimum number of minified pages we keep in the cache, at least twice
+# the number of pages of the build are kept
+MINIFY_CACHE_SIZE = 10000
+# Bumped when the minifiers change so minified outputs are redone
+MINIFY_VERSION = 2
+
+# The number of entries in a feed, override with 'feed_size' in params.json
+FEED_SIZE = 20
+# The maximum number of urls in a sitemap file, larger sitemaps are split
+SITEMAP_SIZE = 50000
+
+# The number of slowest pages and images in the profile report
+PROFILE_TOP = 10
+
+# The image variants we generate of every image, override with 
+# 'image_variants' in params.json. Height is optional.
+IMAGE_VARIANTS = [
+    {"name": "web", "width": 1280, "height": 720, "format": "JPEG"},
+    {"name": "thumb", "width": 384, "height": 216, "format": "JPEG"},
+]
+IMAGE_FORMATS = { # format: (extension, mimetype, save options)
+    "JPEG": (".jpg", "image/jpeg", {"optimize": True, "progressive": True}),
+    "WEBP": (".webp", "image/webp", {"method": 4}),
+    "AVIF": (".avif", "image/avif", {}),
+    "PNG": (".png", "image/png", {"optimize": True}),
+}
+
+# The markdown extensions we use, changing them invalidates the cache
+MARKDOWN_EXTENSIONS = ['tables', 'meta', 'codehilite', 'toc']
+
+# Maximum number of highlighted code blocks we keep in the cache
+HILITE_CACHE_SIZE = 10000
+# Minimum number of converted markdown files we keep in the cache, at 
+# least twice the number of pages of the build are kept
+MARKDOWN_CACHE_SIZE = 1000
+# Minimum number of generated images we keep in the cache, at least twice 
+# the number of image variants of the build are kept
+IMAGE_CACHE_SIZE = 1000
+
+try:
+    from pygments import __version__ as pygments_version
+except ImportError:
+    pygments_version = None
+# the configuration of codehilite changes the html of the code blocks
+HILITE_CONFIG = CodeHiliteExtension().getConfigs()
+
+class CachedHiliteTreeprocessor(HiliteTreeprocessor):
+    """
+    The codehilite tree processor but the highlighted code blocks are
+    cached by their code and options, see prune_cache for the eviction
+    """
+    def run(self, root):
+        for block in root.iter('pre'):
+            if len(block) == 1 and block[0].tag == 'code':
+                text = block[0].text
+                if text is None:
+                    continue
+                text = self.code_unescape(text)
+                key = hash_data(text, self.config, self.md.tab_length, pygments_version)
+                html = cache_get("highlight", key, cache_path=self.md.cache_path,
+                                 _profile=self.md.profile)
+                if html is None:
+                    local_config = self.config.copy()
+                    code = CodeHilite(
+                        text,
+                        tab_length=self.md.tab_length,
+                        style=local_config.pop('pygments_style', 'default'),
+                        **local_config
+                    )
+                    html = code.hilite()
+                    cache_put("highlight", key, html, cache_path=self.md.cache_path)
+                placeholder = self.md.htmlStash.store(html)
+                # Change to a `p` element which is removed when the raw 
+                # html is inserted, just like codehilite does
+                block.clear()
+                block.tag = 'p'
+                block.text = placeholder
+
+class ExtractTreeprocessor(Treeprocessor):
+    """
+    Find the first paragraph (summary) and image (thumbnail) of a document
+    in its element tree while converting, so we don't need to search the
+    html, see extract_meta. The result is saved as md.first.
+    """
+    def run(self, root):
+        summary = img = None
+        for el in root.iter():
+            if img is None:
+                img = el.get("src") if el.tag == "img" else self.raw_img(el)
+            if el.tag == "p" and summary is None and not self.is_raw_block(el):
+                summary = self.inner_html(el)
+            if summary is not None and img is not None:
+                break
+        self.md.first = {"summary": summary, "thumbnail": img}
+
+    def raw_img(self, el):
+        """Return the src of the first image in the raw html of an element, it isn't in the tree"""
+        for text in (el.text, el.tail):
+            for m in HTML_PLACEHOLDER_RE.finditer(text or ""):
+                index = int(m.group(1))
+                if index < len(self.md.htmlStash.rawHtmlBlocks):
+                    found = IMG_RE.search(str(self.md.htmlStash.rawHtmlBlocks[index]))
+                    if found:
+                        return found.group(1)
+        return None
+
+    def is_raw_block(self, el):
+        """Check if a paragraph holds a block of raw html, its <p> isn't in the html"""
+        m = HTML_PLACEHOLDER_RE.fullmatch(el.text or "")
+        if not m or len(el):
+            return False
+        index = int(m.group(1))
+        raw = self.md.postprocessors['raw_html']
+        return index < len(self.md.htmlStash.rawHtmlBlocks) and \
+               raw.isblocklevel(str(self.md.htmlStash.rawHtmlBlocks[index]))
+
+    def inner_html(self, el):
+        """Return the html of the content of an element like it is in the html"""
+        tail, el.tail = el.tail, None
+        html = self.md.serializer(el)
+        el.tail = tail
+        html = html[html.index(">") + 1:html.rindex("<")]
+        for pp in self.md.postprocessors:
+            html = pp.run(html)
+        return html
+
+# Every process creates its markdown converter once, see get_markdown
+_markdown = None
+
+def get_markdown(**params):
+    """
+    Return the markdown converter of this process, reset so it's ready
+    for a new document. Creating a converter registers all extensions
+    which is expensive so we do it only once.
+    """
+    global _markdown
+    if _markdown is None:
+        _markdown = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        # replace codehilite's tree processor by our caching one
+        hiliter = CachedHiliteTreeprocessor(_markdown)
+        hiliter.config = _markdown.treeprocessors['hilite'].config
+        _markdown.treeprocessors.register(hiliter, 'hilite', 30)
+        # after all other tree processors, i.e. unescape
+        _markdown.treeprocessors.register(ExtractTreeprocessor(_markdown), 'extract', -10)
+    _markdown.cache_path = params.get("cache_path", ".appie-cache")
+    _markdown.profile = params.get("_profile")
+    # an empty document isn't processed at all
+    _markdown.first = {"summary": None, "thumbnail": None}
+    return _markdown.reset()
+
 def fread(filename):
     """Read file and close the file."""
     with open(filename, 'r') as f:
         return f.read()
 
 def fwrite(filename, text):
-    """Write content to file and close the file."""
+    """
+    Write content to file and close the file. We write to a temporary
+    file first so nobody ever reads a partially written file.
+    """
     basedir = os.path.dirname(filename)
-    if not os.path.isdir(basedir):
-        os.makedirs(basedir)
+    if basedir and not os.path.isdir(basedir):
+        os.makedirs(basedir, exist_ok=True)
 
-    with open(filename, 'w') as f:
+    tmpfile = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmpfile, 'wb' if isinstance(text, bytes) else 'w') as f:
         f.write(text)
+    os.replace(tmpfile, filename)
 
 def fix_meta(meta):
     for k,v in meta.items():
         if len(v) == 1:
             meta[k] = v[0]
 
-def is_source_newer(source: str, target: str) -> bool:
+def new_manifest():
+    """Return an empty build manifest"""
+    return {"version": MANIFEST_VERSION,
+            "sources": {},      # srcpath: [mtime, size, hash]
+            "templates": {},    # template name: hash incl. its dependencies
+            "images": {},       # srcpath: [mtime, size, [width, height]]
+            "meta": {},         # srcpath: [hash, meta data of the page, params hash]
+            "outputs": {},      # outfile: {"key": hash}
+            "static": {},       # path in the static dir: [mtime, size]
+            "compressed": {},   # path in the output dir: [mtime, size, hash]
+            "compress_formats": [], # the formats of the compressed siblings
+            "plugins": {},      # srcpath: [key, handled, meta] of cacheable transforms
+            "output_path": None # the dir the outputs were generated in
+            }
+
+def load_manifest(output_path, cache_path=".appie-cache"):
     """
-    Checks if the source file is newer than the target file.
+    Load the manifest of the previous build from the output dir.
+    Returns an empty manifest if there is none or it can't be read.
+    The sections of the source files are read from the metadata db 
+    when a file is looked up.
     """
+    manifest = None
     try:
-        # Check if the source file exists
-        if not os.path.exists(source):
-            raise FileNotFoundError(f"Source file '{source}' does not exist.")
-        
-        # Check if the target file exists
-        if not os.path.exists(target):
-            # If the target doesn't exist, consider source as newer
-            return True
-        
-        # Get the modification times
-        source_mtime = os.path.getmtime(source)
-        target_mtime = os.path.getmtime(target)
-        
-        # Compare the modification times
-        return source_mtime > target_mtime
-    except Exception as e:
-        print(f"Error: {e}")
+        manifest = json.loads(fread(os.path.join(output_path, MANIFEST_NAME)))
+    except (OSError, ValueError):
+        pass
+    if not manifest or manifest.get("version") != MANIFEST_VERSION:
+        manifest = new_manifest()
+    store = MetaStore(os.path.join(cache_path, METADB_NAME))
+    for section in METADB_SECTIONS:
+        manifest[section] = MetaSection(store, section)
+    return manifest
+
+def rebase_manifest(manifest, output_path):
+    """Move the outputs of a manifest to another output dir"""
+    old = manifest.get("output_path")
+    if old and old != output_path:
+        manifest["outputs"] = {os.path.join(output_path, os.path.relpath(f, old)): rec
+                               for f, rec in manifest["outputs"].items()}
+    manifest["output_path"] = output_path
+
+def save_manifest(manifest, output_path, cache_path=".appie-cache", input_path=None):
+    """
+    Save the manifest of this build to the output dir and the sections
+    of the source files to the metadata db. The files of the input_path
+    which are not in the manifest are removed from the db.
+    """
+    fwrite(os.path.join(output_path, MANIFEST_NAME), 
+           json.dumps({k: v for k, v in manifest.items() if k not in METADB_SECTIONS}))
+    if all(isinstance(manifest[k], dict) for k in METADB_SECTIONS):
+        MetaStore(os.path.join(cache_path, METADB_NAME)).save(manifest, input_path)
+
+# every process opens the metadata db once, see MetaStore.db
+_metadb = {}
+
+class MetaStore:
+    """
+    The metadata db: the mtime, size and hash of every source file, the
+    size of an image and the meta data of a page. It's only written at
+    the end of a build and only the files which changed are written. A
+    store is sent to the worker processes by its path only, they open 
+    the db themselves.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rows = None
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def db(self):
+        """Return the connection of this process to the db"""
+        key = (os.getpid(), self.path)
+        db = _metadb.get(key)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # builds run one at a time but dev.py runs them on other threads
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, "
+                       "size INTEGER, hash TEXT, width INTEGER, height INTEGER, meta TEXT)")
+            _metadb[key] = db
+        return db
+
+    def row(self, path):
+        """
+        Return the row of a source file. All rows are read at the first 
+        lookup, one query is a lot faster than a query for every file.
+        """
+        if self.rows is None:
+            self.rows = {row[0]: row[1:] for row in self.db().execute(
+                         "SELECT path, mtime, size, hash, width, height, meta FROM files")}
+        return self.rows.get(path)
+
+    def save(self, manifest, input_path=None):
+        """
+        Write the sections of the manifest and remove the files in the 
+        input_path it doesn't have. The cache dir, and so the db, is 
+        shared by every content dir we build, i.e. the tests.
+        """
+        sources, images, meta = (manifest[k] for k in METADB_SECTIONS)
+        new = {}
+        for path in sources.keys() | images.keys():
+            mtime, size = (sources.get(path) or images[path])[:2]
+            h = sources[path][2] if path in sources else None
+            width, height = images[path][2] if path in images else (None, None)
+            m = json.dumps(meta[path][1:], sort_keys=True) if path in meta else None
+            new[path] = (mtime, size, h, width, height, m)
+        db = self.db()
+        old = {row[0]: row[1:] for row in db.execute(
+               "SELECT path, mtime, size, hash, width, height, meta FROM files")}
+        with db:
+            if input_path:
+                prefix = os.path.join(input_path, "")
+                db.executemany("DELETE FROM files WHERE path = ?",
+                               ((p,) for p in old.keys() - new.keys() if p.startswith(prefix)))
+            db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           ((p, *row) for p, row in new.items() if old.get(p) != row))
+        self.rows = None
+
+class MetaSection:
+    """A section of the manifest of the previous build read from a MetaStore"""
+    def __init__(self, store, section):
+        self.store = store
+        self.section = section
+
+    def get(self, path, default=None):
+        row = self.store.row(path)
+        if row is None:
+            return default
+        mtime, size, h, width, height, meta = row
+        if self.section == "sources" and h is not None:
+            return [mtime, size, h]
+        if self.section == "images" and width is not None:
+            return [mtime, size, [width, height]]
+        if self.section == "meta" and meta is not None:
+            meta = json.loads(meta)
+            # rows of older versions have the meta data only
+            return [h, *meta] if isinstance(meta, list) else default
+        return default
+
+def hash_data(*parts):
+    """Return a hash of the provided json serializable data"""
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+def file_stat(file):
+    """Return the stat of a file in the tree, a Node has it from the walk"""
+    st = getattr(file, "stat", None)
+    return st if st is not None else os.stat(file["_srcpath"])
+
+def file_hash(path, st=None, **params):
+    """
+    Return the md5 content hash of a file. If the file's mtime and size 
+    match the previous build we reuse the hash from the manifest. Pass
+    st if we already know the stat of the file.
+    """
+    st = st or os.stat(path)
+    old = params.get("_manifest")
+    rec = old and old["sources"].get(path)
+    if rec and rec[0] == st.st_mtime and rec[1] == st.st_size:
+        h = rec[2]
+    else:
+        h = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+        h = h.hexdigest()
+    new = params.get("_newmanifest")
+    if new is not None:
+        new["sources"][path] = [st.st_mtime, st.st_size, h]
+    return h
+
+def image_size(path, st=None, **params):
+    """
+    Return the (width, height) of an image. Only the image header is read 
+    and the size is reused from the manifest if the image didn't change.
+    """
+    st = st or os.stat(path)
+    old = params.get("_manifest")
+    rec = old and old["images"].get(path)
+    if rec and rec[0] == st.st_mtime and rec[1] == st.st_size:
+        size = tuple(rec[2])
+    else:
+        # opening an image only reads its header, it is not decoded
+        with Image.open(path) as img:
+            size = img.size
+    new = params.get("_newmanifest")
+    if new is not None:
+        new["images"][path] = [st.st_mtime, st.st_size, list(size)]
+    return size
+
+def template_hash(name, **params):
+    """
+    Return a hash of a template and every template it references
+    through extends, include or import
+    """
+    new = params.get("_newmanifest")
+    if new is not None and name in new["templates"]:
+        return new["templates"][name]
+    source, filename, uptodate = env.loader.get_source(env, name)
+    deps = [source]
+    for ref in jinja_meta.find_referenced_templates(env.parse(source)):
+        if ref and ref != name:
+            deps.append(template_hash(ref, **params))
+    h = hash_data(*deps)
+    if new is not None:
+        new["templates"][name] = h
+    return h
+
+def template_state(name):
+    """
+    Return the names of the build state which isn't in the params hash,
+    _tags and/or _latest, that a template or a template it references uses
+    """
+    if name not in _state_templates:
+        # a template referencing itself doesn't recurse
+        _state_templates[name] = frozenset()
+        ast = env.parse(env.loader.get_source(env, name)[0])
+        uses = set(STATE_NAMES) & jinja_meta.find_undeclared_variables(ast)
+        for ref in jinja_meta.find_referenced_templates(ast):
+            if ref and ref != name:
+                uses |= template_state(ref)
+        _state_templates[name] = frozenset(uses)
+    return _state_templates[name]
+
+def params_hash(**params):
+    """
+    Return a hash of the site parameters. Keys starting with an 
+    underscore hold build state and are skipped, as are build options.
+    The css we inline in pages and the hash of the plugins are included.
+    """
+    return hash_data({k: v for k, v in params.items() 
+                      if not k.startswith("_") and k not in BUILD_OPTIONS},
+                     params.get("_css"), params.get("_plugins"))
+
+def state_hash(names=STATE_NAMES, **params):
+    """
+    Return a hash of the parts (names) of the build state which is passed
+    to the templates: the names of all tags and the latest nav entries.
+    Returns None if none of it is used, see template_state.
+    """
+    if not names:
+        return None
+    return hash_data(sorted(params.get("_tags", {})) if "_tags" in names else None,
+                     [latest_key(e, **params) for e in params.get("_latest", [])] 
+                     if "_latest" in names else None)
+
+def latest_key(entry, **params):
+    """
+    Return the part of the state hash of a latest nav entry. Pages are
+    rendered while the meta data of the entry may not be complete yet,
+    so the hash of its source stands in for its meta data.
+    """
+    if entry.get("_type") == "dir":
+        return entry["_path"]
+    st = file_stat(entry)
+    if entry.get("_ext") not in (".md", ".html"):
+        return [entry.get("url"), st.st_mtime, st.st_size]
+    return [entry.get("url"), file_hash(entry["_srcpath"], st, **params)]
+
+def is_output_current(outfile, key, **params):
+    """
+    Check if an output exists and was generated from the same inputs
+    (key) during the previous build.
+    """
+    old = params.get("_manifest")
+    if not old:
         return False
-    
+    rec = old["outputs"].get(outfile)
+    return bool(rec) and rec["key"] == key and os.path.exists(outfile)
+
+def record_output(outfile, key, **params):
+    """Save the key of a generated output to the manifest"""
+    new = params.get("_newmanifest")
+    if new is not None:
+        new["outputs"][outfile] = {"key": key}
+
+def page_meta(file):
+    """Return the meta data of a parsed page we want to keep in the manifest"""
+    return {k: v for k, v in file.items() if k != "content" and not k.startswith("_")}
+
+def entry_key(entry, **params):
+    """
+    Return the part of the key of an index or tag page of one of its 
+    entries: its meta data and, as a template may show the content of 
+    a page, the hash of its source
+    """
+    if entry.get("_type") == "dir":
+        return entry["_path"]
+    if entry.get("_ext") not in (".md", ".html"):
+        return page_meta(entry)
+    return [page_meta(entry), file_hash(entry["_srcpath"], file_stat(entry), **params)]
+
+def page_key(file, template, **params):
+    """
+    Return the key of the inputs a page is generated from or None if
+    it's not a page or there's no manifest
+    """
+    if file["_ext"] not in (".md", ".html") or params.get("_manifest") is None:
+        return None
+    return hash_data(file_hash(file["_srcpath"], file_stat(file), **params),
+                     template.name, template_hash(template.name, **params),
+                     params_hash(**params), file.get("_transformed"),
+                     state_hash(template_state(template.name), **params))
+
+def page_outfile(file, **params):
+    """Return the output file of a page"""
+    return os.path.join(params["output_path"], file["_sitedir"], file["_filename"] + ".html")
+
+def restore_page(file, key, **params):
+    """
+    Restore the meta data of a page from the manifest if it was generated
+    from the same inputs (key) during the previous build. Returns True if
+    the page is current and doesn't need to be generated. The meta data 
+    is read from the meta section, which is kept in the metadata db.
+    """
+    if not key:
+        return False
+    outfile = page_outfile(file, **params)
+    meta = current_meta(file, **params)
+    # a post_render hook which can't be cached runs for every page
+    if meta is None or not hook_flag("post_render", "cacheable") or \
+       not is_output_current(outfile, key, **params):
+        count_cache("pages", False, **params)
+        return False
+    count_cache("pages", True, **params)
+    file.update(meta)
+    record_page(file, key, **params)
+    drop_content(file, **params)
+    return True
+
+def current_meta(file, **params):
+    """
+    Return the meta data of a page from the manifest or None if its
+    source or the params, incl. the plugins, changed since it was saved.
+    The metadata db is shared by builds with other params.
+    """
+    old = params.get("_manifest")
+    rec = old and old["meta"].get(file["_srcpath"])
+    if rec and rec[0] == file_hash(file["_srcpath"], file_stat(file), **params) and \
+       rec[2:] == [params_hash(**params)]:
+        return rec[1]
+    return None
+
+def record_page(file, key, **params):
+    """
+    Save a generated page and its meta data to the manifest. A plugin 
+    may set values which can't be saved as json, i.e. a date, the page
+    is generated every build then.
+    """
+    meta = page_meta(file)
+    record_output(page_outfile(file, **params), key, **params)
+    new = params.get("_newmanifest")
+    if new is None:
+        return
+    if is_json(meta):
+        new["meta"][file["_srcpath"]] = [file_hash(file["_srcpath"], file_stat(file), **params), meta,
+                                         params_hash(**params)]
+    else:
+        new["meta"].pop(file["_srcpath"], None)
+
+def is_json(value):
+    """Check if a value can be saved as json"""
+    try:
+        json.dumps(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def markdown_key(file, **params):
+    """Return the key of the html of a .md file in the markdown cache"""
+    return hash_data(file_hash(file["_srcpath"], file_stat(file), **params),
+                     MARKDOWN_EXTENSIONS, markdown.__version__, pygments_version, HILITE_CONFIG)
+
+def drop_content(file, **params):
+    """
+    Drop the rendered content of a written page so the content of all 
+    pages isn't kept in memory. A Node loads it again if it's used later.
+    """
+    file.pop("content", None)
+    if isinstance(file, Node):
+        file.content_ref = (file["_ext"], file["_srcpath"], params.get("cache_path", ".appie-cache"),
+                            markdown_key(file, **params) if file["_ext"] == ".md" else None)
+
+def load_content(ext, srcpath, cache_path, mdkey):
+    """Load the content of a page dropped by drop_content"""
+    if ext != ".md":
+        return fread(srcpath)
+    cached = cache_get("markdown", mdkey, cache_path=cache_path)
+    if cached:
+        return cached["html"]
+    return get_markdown(cache_path=cache_path).convert(fread(srcpath))
+
+def cache_file(kind, key, **params):
+    """Return the path of a cache entry"""
+    return os.path.join(params.get("cache_path", ".appie-cache"), kind, key[:2], key + ".json")
+
+def cache_get(kind, key, **params):
+    """
+    Return a json value from the cache or None if it's not cached. The
+    mtime of a cache entry is its last use, see prune_cache.
+    """
+    path = cache_file(kind, key, **params)
+    try:
+        value = json.loads(fread(path))
+        os.utime(path)
+        count_cache(kind, True, **params)
+        return value
+    except (OSError, ValueError):
+        count_cache(kind, False, **params)
+        return None
+
+def prune_cache(kind, size, **params):
+    """
+    Remove the least recently used entries if the cache has more than 
+    size entries. Entries which are hardlinked from an output, i.e. 
+    generated images, are removed last.
+    """
+    entries = []
+    try:
+        with os.scandir(os.path.join(params.get("cache_path", ".appie-cache"), kind)) as dirs:
+            for d in dirs:
+                if d.is_dir():
+                    with os.scandir(d.path) as files:
+                        for f in files:
+                            st = f.stat()
+                            entries.append((st.st_nlink > 1, st.st_mtime, f.path))
+    except FileNotFoundError:
+        return
+    if len(entries) > size:
+        entries.sort()
+        for linked, mtime, path in entries[:len(entries) - size]:
+            os.remove(path)
+
+def cache_put(kind, key, value, **params):
+    """Save a json value to the cache"""
+    fwrite(cache_file(kind, key, **params), json.dumps(value))
+
+def new_profile():
+    """Return an empty build profile, see timed() and count_cache()"""
+    return {"phases": {},       # phase: seconds
+            "pages": {},        # srcpath: seconds
+            "images": {},       # srcpath: seconds
+            "cache": {}         # kind: [hits, misses]
+            }
+
+def add_time(phase, seconds, name=None, **params):
+    """Add the time spent in a phase, and on a page or image, to the profile"""
+    prof = params.get("_profile")
+    if prof is None:
+        return
+    prof["phases"][phase] = prof["phases"].get(phase, 0) + seconds
+    if name:
+        items = prof["images" if phase == "image" else "pages"]
+        items[name] = items.get(name, 0) + seconds
+
+@contextlib.contextmanager
+def timed(phase, name=None, **params):
+    """Time a phase of the build, and of a page or image if name is given"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(phase, time.perf_counter() - start, name, **params)
+
+def count_cache(kind, hit, **params):
+    """Count a cache hit or miss in the profile"""
+    prof = params.get("_profile")
+    if prof is not None:
+        prof["cache"].setdefault(kind, [0, 0])[0 if hit else 1] += 1
+
+def merge_profile(profile, **params):
+    """Merge the profile of a worker into this build's profile"""
+    for phase, seconds in profile["phases"].items():
+        add_time(phase, seconds, **params)
+    for kind in ("pages", "images"):
+        for name, seconds in profile[kind].items():
+            items = params["_profile"][kind]
+            items[name] = items.get(name, 0) + seconds
+    for kind, (hits, misses) in profile["cache"].items():
+        counts = params["_profile"]["cache"].setdefault(kind, [0, 0])
+        counts[0] += hits
+        counts[1] += misses
+
+def profile_report(profile, total, top=PROFILE_TOP):
+    """
+    Return the report of a build profile. Phases which ran on workers are
+    the sum of the time of all workers so they can add up to more than the
+    total.
+    """
+    def slowest(items):
+        return [[name, round(t, 6)] for name, t in 
+                sorted(items.items(), key=lambda i: i[1], reverse=True)[:top]]
+    return {"total": round(total, 6),
+            "phases": {p: round(t, 6) for p, t in profile["phases"].items()},
+            "slowest_pages": slowest(profile["pages"]),
+            "slowest_images": slowest(profile["images"]),
+            "cache": {kind: {"hits": hits, "misses": misses,
+                             "hit_rate": round(hits / (hits + misses), 4)}
+                      for kind, (hits, misses) in profile["cache"].items()}}
+
+# The part of the stat of a file we use, a whole os.stat_result is a lot
+# bigger and a Node keeps it for the whole build
+FileStat = collections.namedtuple("FileStat", ("st_mtime", "st_size"))
+
+class Node(dict):
+    """
+    A file in the tree. It's a dict, which templates and plugins use, 
+    without any other attributes than its FileStat from the walk and a 
+    reference to its content. The rendered content of a page is dropped
+    once the page is written, see drop_content(). If it's used later on,
+    e.g. by an index template, it's loaded again from the markdown cache
+    or the source.
+    """
+    __slots__ = ("content_ref", "stat")
+
+    def __missing__(self, key):
+        ref = getattr(self, "content_ref", None)
+        if key != "content" or ref is None:
+            raise KeyError(key)
+        return load_content(*ref)
+
 def walk_directory(directory, basepath=None, **params):
     """
     Walk through a directory and collect file meta data.
@@ -108,6 +839,10 @@ def walk_directory(directory, basepath=None, **params):
     """
     if basepath == None:
         basepath=directory
+    # all entries share the path of their dir
+    relfolder = os.path.relpath(directory, basepath)
+    if relfolder == os.curdir:
+        relfolder = ''
         
     dir_dict = {'_path': '',
                 '_srcpath': directory,
@@ -118,8 +853,7 @@ def walk_directory(directory, basepath=None, **params):
             for entry in entries:
                 # entry.name filename
                 # entry.path fullpath relative to called directory
-                relpath = os.path.relpath(entry.path, basepath)
-                relfolder = os.path.dirname(relpath)
+                relpath = os.path.join(relfolder, entry.name)
                 if entry.is_dir():
                     # Recursively include subdirectory
                     d = walk_directory(entry.path, 
@@ -132,163 +866,511 @@ def walk_directory(directory, basepath=None, **params):
                     dir_dict[entry.name] = d
                 else:
                     # Include file as a leaf
-                    filepath = os.path.join(directory, entry.name)
                     userfilename, ext = os.path.splitext(entry.name)
-                    relfile = os.path.join(relfolder, entry.name) # same? os.path.relpath(filepath, directory)
-                    dir_dict[entry.name] = { 
+                    dir_dict[entry.name] = node = Node({
                         "_type": "file", 
                         "_srcpath": entry.path,
                         "_sitedir": relfolder,
                         "_filename": userfilename,
-                        "_ext": ext,
-                        "_sitepath": relfile
-                    }
+                        "_ext": sys.intern(ext),
+                        "_sitepath": relpath
+                    })
+                    # stat every file once, scandir might even know it
+                    st = entry.stat()
+                    node.stat = FileStat(st.st_mtime, st.st_size)
     except PermissionError:
         dir_dict["error"] = "Permission Denied"
     return dir_dict
 
-def read_first_paragraph(html_content):
-    """return the first paragraph found in the html content"""
-    # Assuming paragraphs are separated by double line breaks in HTML
-    paragraphs = html_content.split('<p>')
-    if len(paragraphs) > 1:
-        first_paragraph = paragraphs[1].split('</p>')[0]
-        return first_paragraph
-    else:
-        return None
+# The header meta data of a html page, <!-- key: value --> lines at its start
+HEADER_RE = re.compile(r'\s*<!--\s*(.+?)\s*:\s*(.+?)\s*-->\s*')
+# The src of an image and the start of a paragraph or the src of an image
+IMG_RE = re.compile(r'<img[^>]*src=["\'](.*?)["\']')
+FIRST_RE = re.compile(r'<p>|' + IMG_RE.pattern)
 
-def read_headers(html_content):
-    """Parse headers in text and yield (key, value, end-index) tuples."""
-    for match in re.finditer(r'\s*<!--\s*(.+?)\s*:\s*(.+?)\s*-->\s*|.+', html_content):
-        if not match.group(1):
+def extract_meta(html):
+    """
+    Return the header meta data, the first image (thumbnail) and the
+    first paragraph (summary) of a html page. We scan the html once and 
+    stop as soon as we found the paragraph and the image.
+    """
+    meta = {}
+    pos = 0
+    m = HEADER_RE.match(html)
+    while m:
+        meta[m.group(1)] = m.group(2)
+        pos = m.end()
+        m = HEADER_RE.match(html, pos)
+    summary = img = None
+    for m in FIRST_RE.finditer(html, pos):
+        if m.group(1) is not None:
+            if img is None:
+                img = m.group(1)
+        elif summary is None:
+            end = html.find('</p>', m.end())
+            summary = html[m.end():end if end >= 0 else len(html)]
+        if summary is not None and img is not None:
             break
-        yield match.group(1), match.group(2), match.end()
-
+    if img:
+        meta["thumbnail"] = img
+    meta["summary"] = summary
+    return meta
 
-def read_first_img(html_content):
+def read_front_matter(filename):
     """
-    Find the first <img> tag in the HTML and return it or None if 
-    none found
+    Read the meta data of a markdown file like the markdown meta extension
+    does but stop reading the file at the end of the meta data
     """
-    # Assuming images are done with <img> tag in HTML
-    match = re.search(r'<img[^>]*src=["\'](.*?)["\']', html_content)
-    # Return the src attribute if found
-    if match:
-        return match.group(1)
-    else:
-        return None
+    meta = {}
+    key = None
+    with open(filename, 'r') as f:
+        for i, line in enumerate(f):
+            line = line.rstrip('\n').expandtabs(4)
+            if i == 0 and BEGIN_RE.match(line):
+                continue
+            if line.strip() == '' or END_RE.match(line):
+                break  # blank line or end of YAML header - done
+            m1 = META_RE.match(line)
+            if m1:
+                key = m1.group('key').lower().strip()
+                meta.setdefault(key, []).append(m1.group('value').strip())
+            else:
+                m2 = META_MORE_RE.match(line)
+                if m2 and key:
+                    # Add another line to existing key
+                    meta[key].append(m2.group('value').strip())
+                else:
+                    break  # no meta data - done
+    fix_meta(meta)
+    return meta
+
+def html_meta(file, html):
+    """Save the meta data of a html page to the file"""
+    file.update(extract_meta(html))
 
 def parse_dir(tree, **params):
     """Parse a directory (tree) recursively"""
-    # first check if plugins.py wants this dir
-    if not plugins.match_dir(tree, **params):
+    files, folders = collect_dir(tree, **params)
+    # first read the meta data of all pages
+    with timed("scan", **params):
+        for file in files:
+            scan_path(file, **params)
+    # plugins might change the meta data or handle some files themselves
+    with timed("transform", **params):
+        walked = files
+        files, handled = transform_files(files, **params)
+    # all tags are known once we collected them, in the order of the walk
+    for file in walked:
+        collect_tags(file, **params)
+    # the newest entries of the nav folders
+    if params.get("nav"):
+        params["_latest"].extend(latest_entries(tree, **params))
+    # resizing images and copying other files is deferred
+    params["_images"] = []
+    params["_assets"] = []
+    parse_files(files, **params)
+    process_images(params.pop("_images"), **params)
+    with timed("assets", **params):
+        process_assets(params.pop("_assets"), **params)
+    # generate an index for every dir, subdirs first
+    with timed("index", **params):
+        for folder in folders:
+            generate_index(folder, **params)
+    # all tags are known now so generate the tag pages once
+    if params.get("_tags"):
+        with timed("tags", **params):
+            generate_tags(params["_tags"], **params)
+
+def collect_dir(tree, files=None, folders=None, **params):
+    """
+    Collect the files to parse from a directory (tree) recursively and
+    create their output dirs. Returns a list of files and a list of dirs.
+    The dirs are ordered so subdirs come before their parent.
+    """
+    if files is None:
+        files, folders = [], []
+    # first check if a plugin wants this dir
+    hook = _hooks.get("match_dir")
+    if not (hook and hook(tree, **params)):
         for k, v in tree.items():
             # don't parse leaves
-            if type(v) != dict:
+            if not isinstance(v, dict):
                 continue
             elif v["_type"] == "dir":
                 os.makedirs(os.path.join(params["output_path"], v["_path"]), exist_ok=True)
-                parse_dir(v, **params)  #recurse
+                collect_dir(v, files, folders, **params)  #recurse
             else:
-                # first check if a plugin wants this file
-                if not plugins.match_file(v, **params):
-                    parse_path(v, **params)
-                # save any tags we found to params
-                for t in v.get("tags", []):
-                    st = t.strip()
-                    if not params.get("_tags").get(st):
-                        params["_tags"][st] = []
-                    taglist = params["_tags"].get(st)
-                    taglist.append(v)
-    # generate an index for the dir
-    generate_index(tree, **params)
-    if params.get("_tags"):
-        generate_tags(params["_tags"], **params)
+                files.append(v)
+    folders.append(tree)
+    return files, folders
+
+def tree_files(tree):
+    """Return all files in the tree in the order collect_dir finds them"""
+    files = []
+    for v in tree.values():
+        if isinstance(v, dict):
+            files.extend(tree_files(v) if v["_type"] == "dir" else [v])
+    return files
+
+def tree_dirs(tree):
+    """Return all dirs in the tree, subdirs before their parent"""
+    dirs = []
+    for v in tree.values():
+        if isinstance(v, dict) and v["_type"] == "dir":
+            dirs.extend(tree_dirs(v))
+    dirs.append(tree)
+    return dirs
+
+def latest_entries(tree, **params):
+    """Return the newest entry of every nav folder in the tree"""
+    latest = []
+    for folder in tree_dirs(tree):
+        if folder["_path"] in params.get("nav", []):
+            entries = sort_entries((v for v in folder.values() if isinstance(v, dict)), **params)
+            if entries:
+                latest.append(entries[0])
+    return latest
+
+def file_tags(file):
+    """Return the tags of a file"""
+    tags = file.get("tags", [])
+    # a single tag is a string, i.e. from a html header or after fix_meta
+    if isinstance(tags, str):
+        tags = tags.split(",")
+    return [t.strip() for t in tags if t.strip()]
+
+def collect_tags(file, **params):
+    """save any tags we found in the file to params"""
+    for st in file_tags(file):
+        if not params.get("_tags").get(st):
+            params["_tags"][st] = []
+        taglist = params["_tags"].get(st)
+        taglist.append(file)
+
+def parse_files(files, **params):
+    """
+    Parse the files using parse_path. If more than one job is 
+    requested the files are parsed on a pool of worker processes,
+    unless a plugin has a post_render hook which isn't pure.
+    """
+    jobs = params.get("jobs", 1)
+    # only pure hooks may run in the workers
+    if jobs <= 1 or len(files) <= 1 or not hook_flag("post_render", "pure"):
+        for file in files:
+            parse_path(file, **params)
+        return
+
+    # other files only queue their work so they are not worth sending to 
+    # the workers, neither are pages which are current
+    pages = []
+    for f in files:
+        if f["_ext"] not in (".md", ".html"):
+            parse_path(f, **params)
+        elif not restore_page(f, page_key(f, page_template(f), **params), **params):
+            pages.append(f)
+    files = pages
+    if not files:
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    chunksize = max(1, len(files) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(params,)) as pool:
+        for file, (result, manifest, images, profile) in zip(files, pool.map(_parse_worker, files, 
+                                                                    chunksize=chunksize)):
+            # merge what the worker found back into the tree, the content
+            # of a written page is dropped so take its reference as well
+            file.update(result)
+            if isinstance(file, Node):
+                file.content_ref = getattr(result, "content_ref", None)
+            merge_manifest(manifest, **params)
+            if params.get("_images") is not None:
+                params["_images"].extend(images)
+            if profile:
+                merge_profile(profile, **params)
+
+def merge_manifest(manifest, **params):
+    """Merge the manifest entries a worker recorded into this build's manifest"""
+    new = params.get("_newmanifest")
+    if new is not None:
+        for k in ("sources", "templates", "images", "meta", "outputs"):
+            new[k].update(manifest[k])
+
+# params of a worker process, set once when the worker starts
+_worker_params = None
+
+def _init_worker(params):
+    global _worker_params
+    _worker_params = params
+    # a spawned worker doesn't have the plugins of its parent
+    if params.get("_plugins") and not _hooks:
+        load_plugins(**params)
+
+def _parse_worker(file):
+    """
+    Run parse_path in a worker, return the file, its manifest entries,
+    the images it wants resized and its profile
+    """
+    params = _worker_params
+    manifest = new_manifest()
+    if params.get("_newmanifest") is not None:
+        # keep the template hashes, the parent hashed the page templates
+        # and a template is parsed to find its dependencies
+        manifest["templates"] = params["_newmanifest"]["templates"]
+        params["_newmanifest"] = manifest
+    images = []
+    if params.get("_images") is not None:
+        params["_images"] = images
+    if params.get("_profile") is not None:
+        params["_profile"] = new_profile()
+    parse_path(file, **params)
+    if params.get("_profile") is not None:
+        # the parent already checked if the page is current
+        params["_profile"]["cache"].pop("pages", None)
+    return file, manifest, images, params.get("_profile")
+
+def load_plugins(**params):
+    """
+    Load the hooks of the plugins file, plugins.py or the plugins param.
+    Returns the hash of the file or None if there is no plugins file.
+    A plugins file defines a function for the stages it hooks into:
+
+    pre_walk(**params)              before the content dir is walked
+    match_dir(folder, **params)     return True to skip the dir
+    transform(file, **params)       after the meta data of a file is read,
+                                    return True if the plugin handled it.
+                                    The meta data it sets wins over the
+                                    front matter of the page
+    post_render(file, html, **params)   return the html of a page to write
+    post_build(tree, **params)      when all outputs are generated
+
+    match_file is the old name of transform. A hook declares it's pure,
+    i.e. it only changes the file and writes its own outputs, by setting
+    transform.pure = True. Pure hooks run on the -j worker processes. A
+    cacheable hook (transform.cacheable = True) gives the same result 
+    for the same source file and params, so it's skipped for unchanged
+    files. Without it pages are generated every build.
+    """
+    _hooks.clear()
+    path = params.get("plugins", "plugins.py")
+    if not os.path.isfile(path):
+        return None
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("plugins", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for stage in PLUGIN_STAGES:
+        hook = getattr(module, stage, None)
+        if stage == "transform" and hook is None:
+            hook = getattr(module, "match_file", None)
+        if hook is not None:
+            _hooks[stage] = hook
+    logger.debug("loaded the {} hooks of {}".format(", ".join(_hooks), path))
+    return hash_data(fread(path))
+
+def hook_flag(stage, flag):
+    """Return if the hook of a stage declares the flag (pure or cacheable), True if there's no hook"""
+    hook = _hooks.get(stage)
+    return hook is None or bool(getattr(hook, flag, False))
+
+def transform_key(file, **params):
+    """Return the key of the inputs of the transform hook of a file"""
+    return hash_data(file_hash(file["_srcpath"], file_stat(file), **params), params_hash(**params))
+
+def run_transform(file, **params):
+    """Run the transform hook on a file, return if it handled the file and the meta data it set"""
+    handled = bool(_hooks["transform"](file, **params))
+    return handled, {k: v for k, v in file.items() if not k.startswith("_")}
+
+def _transform_worker(file):
+    """Run the transform hook in a worker"""
+    return run_transform(file, **_worker_params)
+
+def transform_files(files, **params):
+    """
+    Run the transform hook of the plugins on the files. Returns the files
+    the plugins didn't handle, which we parse, and the handled files.
+    The results of a cacheable hook are restored
+    from the manifest for unchanged files, a pure hook runs on the pool
+    of worker processes.
+    """
+    if "transform" not in _hooks:
+        return files, []
+    cacheable = hook_flag("transform", "cacheable")
+    old = params.get("_manifest") or {}
+    new = params.get("_newmanifest")
+    results = {}
+    todo = []
+    for i, file in enumerate(files):
+        rec = old.get("plugins", {}).get(file["_srcpath"])
+        if cacheable and rec and rec[0] == transform_key(file, **params):
+            results[i] = rec[1], rec[2]
+        else:
+            todo.append(i)
+    jobs = params.get("jobs", 1)
+    if jobs > 1 and len(todo) > 1 and hook_flag("transform", "pure"):
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(params,)) as pool:
+            chunksize = max(1, len(todo) // (jobs * 4))
+            results.update(zip(todo, pool.map(_transform_worker, [files[i] for i in todo],
+                                              chunksize=chunksize)))
+    else:
+        results.update((i, run_transform(files[i], **params)) for i in todo)
+
+    remaining, handled_files = [], []
+    for i, file in enumerate(files):
+        handled, meta = results[i]
+        file.update(meta)
+        # pages depend on the meta data the plugin set, parse_path sets it 
+        # again over the meta data of the page
+        file["_transformed"] = hash_data(meta)
+        file["_plugin_meta"] = meta
+        # the meta data is set by the plugin, it may not be saved as json
+        if cacheable and new is not None and is_json(meta):
+            new["plugins"][file["_srcpath"]] = [transform_key(file, **params), handled, meta]
+        (handled_files if handled else remaining).append(file)
+    return remaining, handled_files
 
 def parse_path(file, **params):
     """
     Parse the filepath in the folder, we use the folder name to match a 
     jinja template
     """
-    sitedir = file["_sitedir"]
-    folder = os.path.dirname(file["_sitepath"])
     filename = file["_filename"]
     ext = file["_ext"]
-    dirname = os.path.normpath(folder).split(os.sep)[0] # for templates we use the first dir!
     outfilepath = os.path.join(params["output_path"], file["_sitedir"], filename )
+    template = page_template(file)
+
+    # skip pages which are generated from the same inputs as last build
+    pagekey = page_key(file, template, **params)
+    if restore_page(file, pagekey, **params):
+        if ext == ".html":
+            if file.get("summary"):
+                return {"summary": file["summary"], "url": file["url"]}
+            return {"url": file["url"]}
+        return
 
-    # try to load a corresponding template
-    try:
-        template = env.get_template('{}.html'.format(dirname))
-        print("using the {}.html template for {}".format(dirname, file["_srcpath"]))
-    except Exception as e:
-        template = env.get_template('default.html')
-        
     # match file extensions
     if ext == ".md": # Parse Markdown file
         siteurl = os.path.join( file["_sitedir"], filename )+".html"
-        md = markdown.Markdown(
-                        extensions=[
-                            'tables',
-                            'meta',
-                            'codehilite',
-                            'toc'
-                            ]
-                        )
-        # generate the html from the .md file
-        html = md.convert(fread(file["_srcpath"]))
-        fix_meta(md.Meta)
+        # generate the html from the .md file, or reuse it from the cache
+        mdkey = markdown_key(file, **params)
+        with timed("markdown", file["_srcpath"], **params):
+            cached = cache_get("markdown", mdkey, **params)
+            if cached:
+                html, meta = cached["html"], cached["meta"]
+                # entries cached before we extracted while converting
+                first = cached.get("first") or extract_meta(html)
+            else:
+                md = get_markdown(**params)
+                html = md.convert(fread(file["_srcpath"]))
+                fix_meta(md.Meta)
+                meta = md.Meta
+                first = md.first
+                cache_put("markdown", mdkey, {"html": html, "meta": meta, "first": first}, **params)
         if not file.get('thumbnail'):
-            if not md.Meta.get('thumbnail') and md.Meta.get('images'):
-                if md.Meta.get('images')[0]:
-                    file['thumbnail'] = md.Meta.get('images')[0]
-            if not file.get('thumbnail'):
-                img = read_first_img(html)
-                if img:
-                    file['thumbnail'] = img
-        if not md.Meta.get('summary'):
-            md.Meta['summary'] = read_first_paragraph(html)
-        file.update(md.Meta)
+            if not meta.get('thumbnail') and meta.get('images'):
+                if meta.get('images')[0]:
+                    file['thumbnail'] = meta.get('images')[0]
+            if not file.get('thumbnail') and first.get('thumbnail'):
+                file['thumbnail'] = first['thumbnail']
+        if not meta.get('summary'):
+            meta['summary'] = first.get('summary')
+        file.update(meta)
+        file.update(file.get("_plugin_meta", {}))
         file.update({
                     "content": html,
                     "url": siteurl
                     })
-        sitehtml = template.render(**file, **params)
-        fwrite( "{}.html".format(outfilepath), sitehtml)
+        with timed("render", file["_srcpath"], **params):
+            sitehtml = template.render(**file, **params)
+            if "post_render" in _hooks:
+                sitehtml = _hooks["post_render"](file, sitehtml, **params)
+        with timed("write", file["_srcpath"], **params):
+            write_html("{}.html".format(outfilepath), sitehtml, **params)
+        logger.debug("generated {}.html".format(outfilepath))
+        if pagekey:
+            record_page(file, pagekey, **params)
+        drop_content(file, **params)
     elif ext == ".html": # Parse HTML file
         siteurl = os.path.join( file["_sitedir"], filename )+".html"
         html = fread(file["_srcpath"])
-        # try to find meta data (<!--) in html
-        for key, val, end in read_headers(html):
-            file[key] = val
-        firstimg = read_first_img(html)
-        if firstimg:
-            file["thumbnail"] = firstimg
-        summary = read_first_paragraph(html)
+        html_meta(file, html)
+        file.update(file.get("_plugin_meta", {}))
         file.update({
             "content": html,
-            "summary": summary, 
             "url": siteurl
             })
-        sitehtml = template.render(**file, **params)
-        fwrite( "{}.html".format(outfilepath), sitehtml)
-        summary = read_first_paragraph(html)
-        if summary:
-            return {"summary": summary, "url": siteurl }
+        with timed("render", file["_srcpath"], **params):
+            sitehtml = template.render(**file, **params)
+            if "post_render" in _hooks:
+                sitehtml = _hooks["post_render"](file, sitehtml, **params)
+        with timed("write", file["_srcpath"], **params):
+            write_html("{}.html".format(outfilepath), sitehtml, **params)
+        logger.debug("generated {}.html".format(outfilepath))
+        if pagekey:
+            record_page(file, pagekey, **params)
+        drop_content(file, **params)
+        if file.get("summary"):
+            return {"summary": file["summary"], "url": siteurl }
         return {"url": siteurl}
     elif ext == ".jpg":
         parse_jpg(file, outfilepath, **params)
     elif ext == ".png":
         parse_png(file, outfilepath, **params)
     else:
-        if is_source_newer(file.get("_srcpath"), outfilepath + ext):
-           # just copy
-            shutil.copy(file["_srcpath"], outfilepath + ext)
+        # just copy
+        copy_source(file, outfilepath + ext, **params)
+
+def page_template(file):
+    """Return the jinja template of a page, matched by the first dir of its path"""
+    folder = os.path.dirname(file["_sitepath"])
+    dirname = os.path.normpath(folder).split(os.sep)[0] # for templates we use the first dir!
+    # try to load a corresponding template
+    return find_template('{}.html'.format(dirname), 'default.html')
+
+def scan_path(file, **params):
+    """
+    Read the meta data of a page without rendering it. If the source 
+    and the params, incl. the plugins, didn't change we use the meta 
+    data of the previous build. Otherwise we read the front matter of a
+    .md file or the headers of a .html file. The summary and thumbnail
+    of a .md file without these in its front matter need the converted
+    document so parse_path adds them.
+    """
+    ext = file["_ext"]
+    if ext not in (".md", ".html"):
+        return
+    srcpath = file["_srcpath"]
+    meta = current_meta(file, **params)
+    if meta is not None:
+        file.update(meta)
+        return
+    if ext == ".md":
+        file.update(read_front_matter(srcpath))
+    else:
+        html_meta(file, fread(srcpath))
+    file["url"] = os.path.join(file["_sitedir"], file["_filename"]) + ".html"
+
+def copy_source(file, outfile, **params):
+    """
+    Copy a file to the output dir unless its mtime and size are the same
+    as the previous build. The copy is queued if the asset stage is 
+    running, see process_assets.
+    """
+    st = file_stat(file)
+    key = hash_data(st.st_mtime, st.st_size)
+    if not is_output_current(outfile, key, **params):
+        if params.get("_assets") is not None:
+            params["_assets"].append((file["_srcpath"], outfile))
+        else:
+            copy_file(file["_srcpath"], outfile, params.get("asset_links"))
+    record_output(outfile, key, **params)
 
 def parse_png(file, outfilepath, **params):
     """parse png image, save its mimetype and create thumbnails"""
-    if is_source_newer(file.get("_srcpath"), outfilepath + ".png"):
-        shutil.copy(file["_srcpath"], outfilepath + ".png")
+    copy_source(file, outfilepath + ".png", **params)
     outfilepath = os.path.join(params["output_path"], os.path.splitext(file["_sitepath"])[0])
     file['mimetype'] = 'image/png'   # https://www.w3.org/Graphics/PNG/
     file['url'] = os.path.join( file["_sitedir"], file["_filename"] )+".png"
@@ -296,46 +1378,374 @@ def parse_png(file, outfilepath, **params):
 
 def parse_jpg(file, outfilepath, **params):
     """parse jpg image, save its mimetype and create thumbnails"""
-    if is_source_newer(file.get("_srcpath"), outfilepath + ".jpg"):
-        shutil.copy(file["_srcpath"], outfilepath + ".jpg")
+    copy_source(file, outfilepath + ".jpg", **params)
     outfilepath = os.path.join(params["output_path"], os.path.splitext(file["_sitepath"])[0])
     file['mimetype'] = 'image/jpg'
     file['url'] = os.path.join( file["_sitedir"], file["_filename"] )+".jpg"
     resize_img(file, outfilepath, **params)
 
+def image_variants(**params):
+    """
+    Return the image variants to generate. The variants are sorted from
+    large to small so every variant can be derived from the previous one.
+    Formats the installed Pillow can't save are skipped.
+    """
+    variants = params.get("image_variants")
+    if variants is None:
+        variants = [dict(v) for v in IMAGE_VARIANTS]
+        # the old jpg_size and thumb_size params still work
+        for v, key in zip(variants, ("jpg_size", "thumb_size")):
+            if params.get(key):
+                v["width"], v["height"] = params[key]
+    Image.init()
+    ret = []
+    for v in variants:
+        fmt = v.get("format", "JPEG").upper()
+        if fmt not in IMAGE_FORMATS or fmt not in Image.SAVE:
+            logger.warning("Image format {} is not supported, skipping variant {}".format(fmt, v))
+            continue
+        ret.append({"name": str(v.get("name", v["width"])),
+                    "width": int(v["width"]),
+                    "height": int(v.get("height") or 0),
+                    "format": fmt,
+                    "quality": int(v.get("quality", 80))})
+    return sorted(ret, key=lambda v: v["width"], reverse=True)
+
+def fit_size(size, variant):
+    """Return the size scaled down to fit the variant, keeping its aspect ratio"""
+    w, h = size
+    scale = variant["width"] / w
+    if variant["height"]:
+        scale = min(scale, variant["height"] / h)
+    if scale >= 1:
+        return (w, h)
+    return (max(1, round(w * scale)), max(1, round(h * scale)))
+
 def resize_img(file, outfilepath, **params):
     """create different sized images of the provided image"""
-    jpg_filename = outfilepath + "_web.jpg"
-    thumb_filename = outfilepath + "_thumb.jpg"
-    img = Image.open(file["_srcpath"])
-    size = img.size
-    if (is_source_newer(file.get("_srcpath"), jpg_filename) or
-        is_source_newer(file.get("_srcpath"), thumb_filename)):
-    
-        if img.mode == 'RGBA' or img.mode == 'P':
-            img = img.convert('RGB')
-        if img.mode in ('RGB', 'CMYK', 'I'):
-            print("saving", jpg_filename)
-
-            img.thumbnail(params.get('jpg_size', (1280, 720)), Image.LANCZOS)
-            img.save(jpg_filename, "JPEG", quality=80,
-                        optimize=True, progressive=True)
-            img.thumbnail(params.get('thumb_size', (384, 216)), Image.LANCZOS)
-            img.save(thumb_filename, "JPEG", quality=80,
-                        optimize=True, progressive=True)
+    srcpath = file["_srcpath"]
+    md5 = file_hash(srcpath, file_stat(file), **params)
+    size = image_size(srcpath, file_stat(file), **params)
+    cache_path = os.path.join(params.get("cache_path", ".appie-cache"), "images")
+    variants = []
+    srcset = {}
+    jobs = []
+    for v in params.get("_image_variants") or image_variants(**params):
+        ext, mimetype, options = IMAGE_FORMATS[v["format"]]
+        filename = file["_filename"] + "_" + v["name"] + ext
+        outfile = outfilepath + "_" + v["name"] + ext
+        # derivatives are cached by the source hash and the variant spec
+        # so identical images are only encoded once
+        key = hash_data(md5, v)
+        cachefile = os.path.join(cache_path, key[:2], key + ext)
+        if not is_output_current(outfile, key, **params):
+            jobs.append((md5, srcpath, v, cachefile, outfile))
+            count_cache("images", False, **params)
         else:
-            print("Image {0} is not a valid color image (mode={1})"
-                           .format(file["_srcpath"], img.mode))
+            count_cache("images", True, **params)
+        record_output(outfile, key, **params)
+
+        url = os.path.join(file["_sitedir"], filename)
+        width, height = fit_size(size, v)
+        variants.append({"name": v["name"], "url": url, "width": width,
+                         "height": height, "mimetype": mimetype})
+        srcset.setdefault(mimetype, []).append("{}{} {}w".format(
+                                        params.get("base_path", "/"), url, width))
+        file[v["name"]] = filename
+
+    # queue the jobs if an image pipeline is running
+    if params.get("_images") is not None:
+        params["_images"].extend(jobs)
+    else:
+        process_images(jobs, **params)
 
-    img.close()
     # update the file's meta data in the dictionary
     file.update({
             'size': size,              # tuple (width,height)
-            'web': file["_filename"] + "_web.jpg",
-            'thumb': file["_filename"] + "_thumb.jpg",
-            'md5': 'todo'
+            'variants': variants,
+            'srcset': {k: ", ".join(v) for k, v in srcset.items()},
+            'md5': md5
             })
 
+def make_derivatives(srcpath, variants):
+    """
+    Generate the missing variants of the image in the cache, every variant 
+    is derived from the previous (larger) one. Then link the variants
+    from the cache to their output files.
+
+    variants is a list of (variant, cachefile, [outfiles]) tuples
+    """
+    todo = [(v, cachefile) for v, cachefile, outfiles in variants
+            if not os.path.exists(cachefile)]
+    if todo:
+        todo.sort(key=lambda t: t[0]["width"], reverse=True)
+        with Image.open(srcpath) as img:
+            # sizes are calculated from the original size like resize_img does
+            orig_size = img.size
+            # let the jpeg decoder scale down while decoding, it's a lot 
+            # faster than decoding the full image. A noop for other formats.
+            w, h = fit_size(orig_size, todo[0][0])
+            img.draft(None, (w * 2, h * 2))
+            if img.mode == 'RGBA' or img.mode == 'P':
+                img = img.convert('RGB')
+            if img.mode not in ('RGB', 'CMYK', 'I'):
+                logger.warning("Image {0} is not a valid color image (mode={1})"
+                               .format(srcpath, img.mode))
+                return
+            for v, cachefile in todo:
+                logger.debug("saving {}".format(cachefile))
+                size = fit_size(orig_size, v)
+                if size != img.size:
+                    img = img.resize(size, Image.LANCZOS, reducing_gap=2.0)
+                ext, mimetype, options = IMAGE_FORMATS[v["format"]]
+                os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+                # save to a temporary file so we never leave a partial file in the cache
+                tmpfile = "{}.{}.tmp".format(cachefile, os.getpid())
+                if v["format"] == "PNG":
+                    img.save(tmpfile, v["format"], **options)
+                else:
+                    img.save(tmpfile, v["format"], quality=v["quality"], **options)
+                os.replace(tmpfile, cachefile)
+    for v, cachefile, outfiles in variants:
+        for outfile in outfiles:
+            link_file(cachefile, outfile)
+
+def link_file(source, target):
+    """Hardlink source to target or copy it if we can't link"""
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+    tmpfile = "{}.{}.tmp".format(target, os.getpid())
+    if os.path.lexists(tmpfile):
+        os.remove(tmpfile)
+    try:
+        os.link(source, tmpfile)
+    except OSError:
+        shutil.copyfile(source, tmpfile)
+    os.replace(tmpfile, target)
+
+def copy_file(source, target, link=False):
+    """
+    Copy source to target keeping its mtime. If link is set we hardlink,
+    else we use copy_file_range so filesystems supporting it can share 
+    the data (reflinks) instead of copying it. The target is replaced at
+    once so it's never read partially written.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if link:
+        link_file(source, target)
+        return
+    tmpfile = "{}.{}.tmp".format(target, os.getpid())
+    try:
+        with open(source, 'rb') as src, open(tmpfile, 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            while size > 0:
+                n = os.copy_file_range(src.fileno(), dst.fileno(), size)
+                if n == 0:
+                    break
+                size -= n
+        if size > 0:
+            raise OSError("short copy")
+    except (AttributeError, OSError):
+        # not supported by the os or the filesystem
+        shutil.copyfile(source, tmpfile)
+    shutil.copystat(source, tmpfile)
+    os.replace(tmpfile, target)
+
+def sync_static(**params):
+    """
+    Sync the static dir to the output dir. Only files whose mtime or size 
+    changed since the previous build are copied and files removed from 
+    the static dir are removed from the output dir. Css is minified if 
+    the minify param is set. Returns the output files which changed.
+    """
+    old = params["_manifest"].get("static", {})
+    new = {}
+    changed = []
+    dirs = ["static"] if os.path.isdir("static") else []
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                    continue
+                st = entry.stat()
+                path = os.path.relpath(entry.path, "static")
+                target = os.path.join(params["output_path"], path)
+                new[path] = [st.st_mtime, st.st_size]
+                minify = params.get("minify") and path.endswith(".css")
+                if minify:
+                    new[path].append(["minified", MINIFY_VERSION])
+                if old.get(path) == new[path] and os.path.exists(target):
+                    continue
+                if minify:
+                    fwrite(target, minify_css(fread(entry.path)))
+                else:
+                    copy_file(entry.path, target, params.get("static_links"))
+                changed.append(target)
+    for path in old.keys() - new.keys():
+        target = os.path.join(params["output_path"], path)
+        if remove_output(target, **params):
+            changed.append(target)
+    params["_newmanifest"]["static"] = new
+    return changed
+
+def remove_output(outfile, **params):
+    """Remove a file from the output dir and the dirs it leaves empty"""
+    if not os.path.isfile(outfile):
+        return False
+    os.remove(outfile)
+    for ext in COMPRESS_FORMATS.values():
+        if os.path.isfile(outfile + ext):
+            os.remove(outfile + ext)
+    root = os.path.normpath(params["output_path"])
+    folder = os.path.dirname(os.path.normpath(outfile))
+    while folder != root and folder.startswith(root) and not os.listdir(folder):
+        os.rmdir(folder)
+        folder = os.path.dirname(folder)
+    return True
+
+def prune_outputs(**params):
+    """
+    Remove the outputs of the previous build which this build didn't
+    generate, i.e. of renamed or deleted content. Files we didn't 
+    generate ourselves are left alone. Returns the removed files.
+    """
+    new = params["_newmanifest"]["outputs"]
+    return [outfile for outfile in params["_manifest"]["outputs"]
+            if outfile not in new and remove_output(outfile, **params)]
+
+def compress_formats(**params):
+    """Return the formats to compress outputs with, see the compress param"""
+    formats = params.get("compress")
+    if not formats:
+        return []
+    if formats is True:
+        formats = list(COMPRESS_FORMATS)
+    if "br" in formats:
+        import importlib.util
+        if importlib.util.find_spec("brotli") is None:
+            # only complain if brotli was asked for explicitly
+            if params["compress"] is not True:
+                logger.warning("Brotli is not installed, skipping .br files")
+            formats = [f for f in formats if f != "br"]
+    return [f for f in formats if f in COMPRESS_FORMATS]
+
+def compress_file(outfile, formats, md5=None):
+    """
+    Write the compressed siblings of an output unless its content hash
+    equals md5. Returns the mtime, size and hash of the output.
+    """
+    st = os.stat(outfile)
+    with open(outfile, 'rb') as f:
+        data = f.read()
+    h = hashlib.md5(data).hexdigest()
+    if h != md5:
+        for fmt in formats:
+            if fmt == "gzip":
+                import gzip
+                compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            else:
+                import brotli
+                compressed = brotli.compress(data)
+            fwrite(outfile + COMPRESS_FORMATS[fmt], compressed)
+    return [st.st_mtime, st.st_size, h]
+
+def thread_map(func, items, **params):
+    """
+    Run func on every item on a pool of threads, one per core or the jobs
+    param. Returns the results in the order of the items, the results are
+    consumed so any exception is raised here.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    workers = params.get("jobs") or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+def compress_outputs(**params):
+    """
+    Write gzip and/or brotli compressed siblings of the html, css, js, xml 
+    and svg outputs and static files. An output which didn't change since 
+    the previous build, or was written with the same content, is skipped.
+    Siblings of formats which are no longer enabled are removed.
+    """
+    formats = compress_formats(**params)
+    root = params["output_path"]
+    old = params["_manifest"].get("compressed", {})
+    # remove the siblings of formats we no longer compress with
+    dropped = [f for f in params["_manifest"].get("compress_formats", COMPRESS_FORMATS) 
+               if f not in formats]
+    for path in old if dropped else ():
+        for fmt in dropped:
+            sibling = os.path.join(root, path) + COMPRESS_FORMATS[fmt]
+            if os.path.isfile(sibling):
+                os.remove(sibling)
+    params["_newmanifest"]["compress_formats"] = formats
+    if not formats:
+        params["_newmanifest"]["compressed"] = {}
+        return
+    new = {}
+    outfiles = list(params["_newmanifest"]["outputs"])
+    outfiles.extend(os.path.join(root, path) for path in params["_newmanifest"]["static"])
+    jobs = []
+    for outfile in outfiles:
+        if not outfile.endswith(COMPRESS_EXTENSIONS) or not os.path.isfile(outfile):
+            continue
+        path = os.path.relpath(outfile, root)
+        rec = old.get(path)
+        if rec and not all(os.path.exists(outfile + COMPRESS_FORMATS[f]) for f in formats):
+            rec = None
+        st = os.stat(outfile)
+        if rec and rec[:2] == [st.st_mtime, st.st_size]:
+            new[path] = rec
+        else:
+            jobs.append((outfile, path, rec and rec[2]))
+    # zlib and brotli release the GIL while compressing
+    results = thread_map(lambda job: compress_file(job[0], formats, job[2]), jobs, **params)
+    for (outfile, path, md5), rec in zip(jobs, results):
+        new[path] = rec
+    params["_newmanifest"]["compressed"] = new
+
+def process_images(images, **params):
+    """
+    Run the queued image jobs on a pool of threads. Pillow releases the 
+    GIL while decoding, resizing and encoding so threads keep all cores 
+    busy. Jobs of identical images are merged so they are encoded once.
+    """
+    if not images:
+        return
+    groups = {}     # md5: (srcpath, {cachefile: (variant, [outfiles])})
+    for md5, srcpath, v, cachefile, outfile in images:
+        srcpath, variants = groups.setdefault(md5, (srcpath, {}))
+        variants.setdefault(cachefile, (v, []))[1].append(outfile)
+    jobs = [(srcpath, [(v, cachefile, outfiles) for cachefile, (v, outfiles) in variants.items()])
+            for srcpath, variants in groups.values()]
+    for srcpath, variants in jobs:
+        for v, cachefile, outfiles in variants:
+            count_cache("image cache", os.path.exists(cachefile), **params)
+
+    def derive(job):
+        start = time.perf_counter()
+        make_derivatives(*job)
+        return time.perf_counter() - start
+
+    if len(jobs) == 1:
+        add_time("image", derive(jobs[0]), jobs[0][0], **params)
+        return
+    for job, seconds in zip(jobs, thread_map(derive, jobs, **params)):
+        add_time("image", seconds, job[0], **params)
+
+def process_assets(assets, **params):
+    """
+    Copy the queued files which are not pages to the output dir on a pool
+    of threads. Copying big media is mostly waiting for the disk so the 
+    copies overlap. copy_file lets the kernel copy the data, or hardlinks 
+    if asset_links is set.
+    """
+    if not assets:
+        return
+    link = params.get("asset_links")
+    thread_map(lambda job: copy_file(*job, link), assets, **params)
+
 def generate_index(folder, **params):
     """Generate an index file for the provided folder"""
     # Trick to debug jinja2 parsing
@@ -344,56 +1754,348 @@ def generate_index(folder, **params):
     #sitehtml = tpl.render(entries=entries, folder=folder, **params)
     #print(sitehtml)
     if folder.get("_skipindex"):
-        print("Skip index requested for {}".format(folder["_srcpath"]))
+        logger.debug("Skip index requested for {}".format(folder["_srcpath"]))
         return # skip index requested so return
     foldername = os.path.dirname(folder["_path"]) or folder["_path"]
-    try:
-        tpl = env.get_template('{}_index.html'.format(foldername))
-        print("using the {}_index.html template for {}".format(foldername, folder["_srcpath"]))
-    except Exception as e:
-        tpl = env.get_template('index.html')
-
-    entries = tuple(v for k, v in folder.items() if type(v) == dict)
-    try:    #try to sort on a date key but filename if it fails
-        entries = sorted(entries, key=lambda x: x["date"], reverse=True)
-        print("Index for {} is sorted by the date key".format(foldername))
-    except:
-        entries = sorted(entries, key=lambda x: x.get("_filename", ""))
-    # save latest nav entries
-    if folder["_path"] in params.get("nav", []):
-        params["_latest"].append(entries[0])
-
-    sitehtml = tpl.render(entries=entries, folder=folder, **params)
-    fwrite( os.path.join(params["output_path"], folder["_path"], "index.html"), sitehtml)    
-
-def generate_tags(taglist, **params):
-    """Generate a tags index for the provided taglist"""
-    try:
-        tpl = env.get_template('tags_index.html')
-        print("using the tags_index template")
-    except Exception as e:
-        tpl = env.get_template('index.html')
+    tpl = find_template('{}_index.html'.format(foldername), 'index.html')
+
+    entries = tuple(v for k, v in folder.items() if isinstance(v, dict))
+    entries = sort_entries(entries, **params)
+
+    # split the entries into pages if requested
+    size = page_size(folder, **params)
+    if size:
+        pages = [entries[i:i + size] for i in range(0, len(entries), size)] or [[]]
+    else:
+        pages = [entries]
+
+    basekey = None
+    if params.get("_manifest") is not None:
+        basekey = hash_data(tpl.name, template_hash(tpl.name, **params),
+                            params_hash(**params), len(pages),
+                            state_hash(template_state(tpl.name), **params))
+    for page, page_entries in enumerate(pages, 1):
+        url = index_url(folder["_path"], page)
+        outfile = os.path.join(params["output_path"], url)
+        key = basekey and hash_data(basekey, page, [entry_key(e, **params) for e in page_entries])
+        if key and is_output_current(outfile, key, **params):
+            record_output(outfile, key, **params)
+            continue
+
+        sitehtml = tpl.render(entries=page_entries, folder=folder, 
+                              page=page, pages=len(pages),
+                              prev_url=index_url(folder["_path"], page - 1) if page > 1 else None,
+                              next_url=index_url(folder["_path"], page + 1) if page < len(pages) else None,
+                              **params)
+        write_html(outfile, sitehtml, **params)
+        if key:
+            record_output(outfile, key, **params)
+
+def index_url(path, page):
+    """Return the url of a page of the index of the dir path"""
+    if page == 1:
+        return os.path.join(path, "index.html")
+    return os.path.join(path, "page", "{}.html".format(page))
+
+def page_size(folder, **params):
+    """
+    Return the number of entries per index page of the folder or 0 for 
+    no pagination. The page_size param is a number or a dict of dir 
+    paths and numbers.
+    """
+    size = params.get("page_size")
+    if isinstance(size, dict):
+        size = size.get(folder["_path"])
+    return size or 0
+
+# date formats we recognise in the date meta data, see parse_date
+DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                "%m-%d-%Y", "%d-%m-%Y", "%Y/%m/%d", "%B %d, %Y", "%b %d, %Y", 
+                "%d %B %Y", "%d %b %Y")
+
+def parse_date(date, date_format=None):
+    """
+    Parse a date string to a datetime. Returns None if it isn't a 
+    date we understand.
+    """
+    # i.e. a date of several lines is a list, which can't be cached
+    if not isinstance(date, str):
+        return None
+    return _parse_date(date, date_format)
+
+@functools.lru_cache(maxsize=None)
+def _parse_date(date, date_format):
+    """Parse a date string, see parse_date"""
+    for fmt in (date_format,) if date_format else DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(date.strip(), fmt)
+        except ValueError:
+            pass
+    return None
+
+def sort_entries(entries, **params):
+    """
+    Sort the entries on their date, newest first. Entries without a 
+    (valid) date come last sorted by their filename.
+    """
+    entries = sorted(entries, key=lambda x: x.get("_filename", x.get("_path", "")))
+    # sort is stable so entries with the same date stay sorted by filename
+    fmt = params.get("date_format")
+    entries.sort(key=lambda x: parse_date(x.get("date"), fmt) or datetime.datetime.min, 
+                 reverse=True)
+    return entries
+
+def generate_tags(taglist, only=None, **params):
+    """
+    Generate a tags index for the provided taglist. A tag page is only
+    rendered if its entries or their meta data changed since last build.
+    If only is given only the tag pages of these tags are considered.
+    """
+    tpl = find_template('tags_index.html', 'index.html')
+
+    basekey = None
+    if params.get("_manifest") is not None:
+        basekey = hash_data(tpl.name, template_hash(tpl.name, **params), params_hash(**params),
+                            state_hash(template_state(tpl.name), **params))
 
     alltags = []
     # write a html doc for every tag
     for tag, entries in taglist.items():
         alltags.append({ "title": tag, "url": "tags/"+tag})
-        foldername = os.path.join("tags", tag)
+        if only is not None and tag not in only:
+            continue
+        outfile = os.path.join(params["output_path"], "tags", tag + ".html")
+        key = basekey and hash_data(basekey, tag, [entry_key(e, **params) for e in entries])
+        if key and is_output_current(outfile, key, **params):
+            record_output(outfile, key, **params)
+            continue
         sitehtml = tpl.render(title=tag, content="<h1>tagged with "+tag+"</h1>",
                                 entries=entries, **params)
-        fwrite( os.path.join(params["output_path"], "tags", tag + ".html"), sitehtml)
+        write_html(outfile, sitehtml, **params)
+        if key:
+            record_output(outfile, key, **params)
     # finally write the tag index
+    outfile = os.path.join(params["output_path"], "tags", "index.html")
+    key = basekey and hash_data(basekey, alltags)
+    if key and is_output_current(outfile, key, **params):
+        record_output(outfile, key, **params)
+        return
     sitehtml = tpl.render(title="tags", content="<h1>All tags</h1>",
                                 entries=alltags, **params)
-    fwrite( os.path.join(params["output_path"], "tags", "index.html"), sitehtml)
+    write_html(outfile, sitehtml, **params)
+    if key:
+        record_output(outfile, key, **params)
 
-def main():
+def minify_css_text(css):
+    """Remove the superfluous whitespace from css without strings or comments"""
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}")
+
+def minify_css(css):
+    """
+    Remove the comments and superfluous whitespace from css. Quoted
+    strings, i.e. of content or url(), are kept as is.
+    """
+    out = []
+    text = []
+    pos = 0
+    for m in MINIFY_CSS_RE.finditer(css):
+        text.append(css[pos:m.start()])
+        if m.group(1):
+            out.append(minify_css_text("".join(text)))
+            out.append(m.group(1))
+            text = []
+        pos = m.end()
+    text.append(css[pos:])
+    out.append(minify_css_text("".join(text)))
+    return "".join(out).strip()
+
+def minify_html(html):
+    """
+    Remove comments and superfluous whitespace from html. The content
+    of <pre>, <textarea> and <script> elements is kept as is, the css
+    of <style> elements is minified.
+    """
+    out = []
+    pos = 0
+    for m in MINIFY_KEEP_RE.finditer(html):
+        out.append(html[pos:m.start()])
+        block = m.group(0)
+        if m.group(1).lower() == "style":
+            start = block.index(">") + 1
+            end = block.rindex("<")
+            block = block[:start] + minify_css(block[start:end]) + block[end:]
+        out.append(block)
+        pos = m.end()
+    out.append(html[pos:])
+    for i in range(0, len(out), 2):
+        text = re.sub(r"<!--(?!\[if).*?-->", "", out[i], flags=re.S)
+        # a run of whitespace renders as a single space
+        text = re.sub(r"\s+", lambda m: "\n" if "\n" in m.group(0) else " ", text)
+        out[i] = MINIFY_BLOCK_RE.sub(r"\1", text)
+    return "".join(out).strip()
+
+def load_css(**params):
+    """
+    Return the minified css of the static files to inline in pages if
+    the inline_css param is set: true for style.css or a list of files
+    """
+    names = params.get("inline_css")
+    if not names:
+        return None
+    if not isinstance(names, list):
+        names = ["style.css"]
+    return {name: minify_css(fread(os.path.join("static", name)))
+            for name in names if os.path.isfile(os.path.join("static", name))}
+
+def inline_css(html, **params):
+    """Replace the links to the stylesheets in params['_css'] by their css"""
+    css = params["_css"]
+    def replace(m):
+        href = m.group(1)
+        if href.startswith(params.get("base_path", "/")):
+            href = href[len(params.get("base_path", "/")):]
+        if "stylesheet" not in m.group(0) or href not in css:
+            return m.group(0)
+        return "<style>{}</style>".format(css[href])
+    return re.sub(r'<link\b[^>]*\bhref="([^"]*)"[^>]*>', replace, html)
+
+def write_html(outfile, html, **params):
+    """
+    Write a generated html page. If the minify param is set it's minified,
+    the result is cached by the hash of the html.
+    """
+    if params.get("_css"):
+        html = inline_css(html, **params)
+    if params.get("minify"):
+        key = hash_data([MINIFY_VERSION, html])
+        minified = cache_get("minify", key, **params)
+        if minified is None:
+            minified = minify_html(html)
+            cache_put("minify", key, minified, **params)
+        html = minified
+    fwrite(outfile, html)
+
+def absolute_url(url, **params):
+    """Return the absolute url of a site url, for feeds and sitemaps"""
+    return params["site_url"].rstrip("/") + params.get("base_path", "/") + url
+
+def write_output(outfile, text, **params):
+    """
+    Write an output we generate without a template, unless the previous
+    build wrote the same text. Its key is the hash of the text.
+    """
+    key = hash_data(text)
+    if not is_output_current(outfile, key, **params):
+        fwrite(outfile, text)
+    record_output(outfile, key, **params)
+
+def feed_entries(folder, **params):
+    """Return the newest pages of the folder for its feed, newest first"""
+    fmt = params.get("date_format")
+    pages = (v for v in folder.values() if isinstance(v, dict) and v["_type"] == "file"
+             and v["_ext"] in (".md", ".html") and "url" in v)
+    # a heap keeps the newest entries, there's no need to sort all of them
+    return heapq.nlargest(params.get("feed_size", FEED_SIZE), pages,
+                          key=lambda x: parse_date(x.get("date"), fmt) or datetime.datetime.min)
+
+def feed_date(file, **params):
+    """Return the date of a feed entry in Atom format, its mtime (UTC) if it has no date"""
+    date = parse_date(file.get("date"), params.get("date_format"))
+    if date is None:
+        date = datetime.datetime.fromtimestamp(file_stat(file).st_mtime, datetime.timezone.utc)
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def generate_feed(folder, **params):
+    """
+    Generate an Atom feed.xml of the newest pages of the folder. It's 
+    made from the meta data of the pages so it's only written if that
+    changed. The feed author is the author param, the site_url if unset.
+    """
+    pages = feed_entries(folder, **params)
+    entries = []
+    for e in pages:
+        url = xml_escape(absolute_url(e["url"], **params))
+        entries.append("""  <entry>
+    <title>{}</title>
+    <link href="{}"/>
+    <id>{}</id>
+    <updated>{}</updated>
+    <summary type="html">{}</summary>
+  </entry>
+""".format(xml_escape(str(e.get("title", e["_filename"]))), url, url,
+           feed_date(e, **params), xml_escape(str(e.get("summary") or ""))))
+    url = xml_escape(absolute_url(folder["_path"] + "/", **params))
+    # an empty feed is as new as the build
+    updated = max((feed_date(e, **params) for e in pages), default=None) or \
+        datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    author = xml_escape(str(params.get("author") or params.get("site_url", "")))
+    text = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>{}</title>
+  <link href="{}"/>
+  <link rel="self" href="{}feed.xml"/>
+  <id>{}</id>
+  <updated>{}</updated>
+  <author><name>{}</name></author>
+{}</feed>
+""".format(xml_escape(folder["_path"]), url, url, url, updated, author, "".join(entries))
+    write_output(os.path.join(params["output_path"], folder["_path"], "feed.xml"), text, **params)
+
+def generate_feeds(tree, **params):
+    """
+    Generate the feeds of the nav folders if the feeds param is true or
+    of the dir paths if it's a list
+    """
+    feeds = params.get("feeds")
+    if not feeds:
+        return
+    paths = feeds if isinstance(feeds, list) else params.get("nav", [])
+    for folder in tree_dirs(tree):
+        if folder["_path"] in paths:
+            generate_feed(folder, **params)
+
+def sitemap_text(tag, entries):
+    """Return a sitemap or sitemap index of the urls"""
+    return """<?xml version="1.0" encoding="utf-8"?>
+<{0} xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+{1}</{0}>
+""".format(tag, "".join("  <{0}><loc>{1}</loc></{0}>\n".format(
+                        "url" if tag == "urlset" else "sitemap", xml_escape(u)) for u in entries))
+
+def generate_sitemap(**params):
+    """
+    Generate a sitemap.xml of all html pages of the build if the sitemap
+    param is set. Sitemaps may hold SITEMAP_SIZE urls so a larger site
+    gets a sitemap index listing sitemap-1.xml, sitemap-2.xml, etc.
+    """
+    if not params.get("sitemap"):
+        return
+    root = params["output_path"]
+    urls = sorted(absolute_url(os.path.relpath(f, root).replace(os.sep, "/"), **params)
+                  for f in params["_newmanifest"]["outputs"] if f.endswith(".html"))
+    outfile = os.path.join(root, "sitemap.xml")
+    if len(urls) <= SITEMAP_SIZE:
+        write_output(outfile, sitemap_text("urlset", urls), **params)
+        return
+    sitemaps = []
+    for i in range(0, len(urls), SITEMAP_SIZE):
+        name = "sitemap-{}.xml".format(i // SITEMAP_SIZE + 1)
+        write_output(os.path.join(root, name), sitemap_text("urlset", urls[i:i + SITEMAP_SIZE]), **params)
+        sitemaps.append(absolute_url(name, **params))
+    write_output(outfile, sitemap_text("sitemapindex", sitemaps), **params)
+
+def site_params():
+    """Return the default parameters updated with params.json"""
     # Default parameters.
     params = {
         'base_path': '/',
         'output_path': '_site',
         'input_path': 'content',
         'subtitle': 'Lorum Ipsum',
+        'cache_path': '.appie-cache',
         'site_url': 'http://localhost:8000',
         'current_year': datetime.datetime.now().year,
         '_tags': {},
@@ -402,37 +2104,288 @@ def main():
     # If params.json exists, load it.
     if os.path.isfile('params.json'):
         params.update(json.loads(fread('params.json')))
-        
-    from_scratch = False
-    for arg in sys.argv:
-        if arg == "-f" :
-            from_scratch = True
-        if arg == "-h":
-            print(helpmsg)         
-            sys.exit(0)
+    return params
+
+def build(params, from_scratch=False):
+    """
+    Build the site. The state of the build (the manifest, tags and latest
+    entries) is kept in params so a next build in the same process can
+    reuse it. Returns the tree of the content dir.
+
+    If the stage param is set we build into a staging dir which replaces
+    the output dir when the build is done. See publish_output().
+    """
+    if not params.get("stage"):
+        return build_site(params, from_scratch)
+    output_path = params["output_path"]
+    params["output_path"] = stage_output(output_path, from_scratch)
+    try:
+        tree = build_site(params, from_scratch)
+        publish_output(params["output_path"], output_path)
+    except BaseException:
+        shutil.rmtree(params["output_path"], ignore_errors=True)
+        raise
+    finally:
+        params["output_path"] = output_path
+    rebase_manifest(params["_manifest"], output_path)
+    return tree
 
+def build_site(params, from_scratch=False):
+    """Build the site in the output dir, see build()"""
+    start = time.perf_counter()
     if from_scratch or not os.path.isdir(params['output_path']):
         # Create a new _site directory from scratch.
-        if os.path.isdir(params['output_path']):
+        if os.path.islink(params['output_path']):
+            # the site of a staged build
+            shutil.rmtree(os.path.realpath(params['output_path']))
+            os.remove(params['output_path'])
+        elif os.path.isdir(params['output_path']):
             shutil.rmtree(params['output_path'])
-    shutil.copytree('static', params['output_path'], dirs_exist_ok=True)
+        params.pop("_manifest", None)
+
+    params["_image_variants"] = image_variants(**params)
+    reset_templates(**params)
+
+    # load the manifest of the previous build if we don't have it, a 
+    # build from scratch doesn't use the metadata db either
+    if from_scratch:
+        params["_manifest"] = new_manifest()
+    elif params.get("_manifest") is None:
+        params["_manifest"] = load_manifest(params["output_path"], params.get("cache_path", ".appie-cache"))
+    rebase_manifest(params["_manifest"], params["output_path"])
+    params["_newmanifest"] = new_manifest()
+    params["_newmanifest"]["output_path"] = params["output_path"]
+    params["_tags"] = {}
+    params["_latest"] = []
+    params["_css"] = load_css(**params)
+    params["_plugins"] = load_plugins(**params)
+
+    # copy what changed in the static dir
+    with timed("static", **params):
+        sync_static(**params)
+
+    if "pre_walk" in _hooks:
+        _hooks["pre_walk"](**params)
 
     # walk the content dir to a dict and list of folders
-    tree = walk_directory(params["input_path"], **params)
+    with timed("walk", **params):
+        tree = walk_directory(params["input_path"], **params)
                     
     # get nav entries from the root dir:
-    if not params.get("nav"):
+    if not params.get("nav") or params.get("_autonav"):
         nav = []
         for k in sorted(tree):
-            if type(tree[k]) != dict:
+            if not isinstance(tree[k], dict):
                 continue
             if tree[k].get("_type") == "dir":
                 nav.append(k)
 
         params["nav"] = nav
+        params["_autonav"] = True
 
     # process all the dirs files in the tree
     parse_dir(tree, **params)
+    with timed("feeds", **params):
+        generate_feeds(tree, **params)
+    with timed("sitemap", **params):
+        generate_sitemap(**params)
+    if "post_build" in _hooks:
+        _hooks["post_build"](tree, **params)
+
+    # remove what the previous build generated but we didn't
+    with timed("prune", **params):
+        removed = prune_outputs(**params)
+    with timed("compress", **params):
+        compress_outputs(**params)
+
+    old, new = params["_manifest"]["outputs"], params["_newmanifest"]["outputs"]
+    generated = sum(1 for f, rec in new.items() if f not in old or old[f]["key"] != rec["key"])
+    logger.info("{} files, {} generated, {} removed in {:.2f}s".format(
+                len(new), generated, len(removed), time.perf_counter() - start))
+
+    # save what we generated for the next build
+    save_manifest(params["_newmanifest"], params["output_path"], params.get("cache_path", ".appie-cache"),
+                  params["input_path"])
+    params["_manifest"] = params.pop("_newmanifest")
+    prune_cache("highlight", params.get("highlight_cache_size", HILITE_CACHE_SIZE), **params)
+    prune_cache("markdown", params.get("markdown_cache_size", 
+                max(MARKDOWN_CACHE_SIZE, 2 * len(params["_manifest"]["meta"]))), **params)
+    images = len(params["_manifest"]["images"]) * len(params["_image_variants"])
+    prune_cache("images", params.get("image_cache_size", max(IMAGE_CACHE_SIZE, 2 * images)), **params)
+    if params.get("minify"):
+        pages = sum(1 for f in params["_manifest"]["outputs"] if f.endswith(".html"))
+        prune_cache("minify", params.get("minify_cache_size", max(MINIFY_CACHE_SIZE, 2 * pages)), **params)
+    return tree
+
+def stage_output(output_path, from_scratch=False):
+    """
+    Return a new staging dir for the output dir. Unless we build from
+    scratch it starts as a hardlinked copy of the current site so only
+    what changed is generated. As we replace files instead of writing 
+    into them this never changes the current site.
+    """
+    staging = "{}.{}".format(os.path.normpath(output_path),
+                             datetime.datetime.now().strftime("%Y%m%d%H%M%S%f"))
+    if os.path.isdir(output_path) and not from_scratch:
+        shutil.copytree(os.path.realpath(output_path), staging, 
+                        symlinks=True, copy_function=os.link)
+    else:
+        os.makedirs(staging)
+    return staging
+
+def publish_output(staging, output_path):
+    """
+    Make the output dir a symlink to the staging dir and remove the 
+    previous site. Replacing a symlink is atomic so a web server serving
+    the output dir sees either the previous or the new site. Only the
+    first time, when the output dir is a plain dir, it's briefly missing.
+    """
+    output_path = os.path.normpath(output_path)
+    old = None
+    if os.path.islink(output_path):
+        old = os.path.realpath(output_path)
+    elif os.path.isdir(output_path):
+        old = output_path + ".old"
+        # left behind by an interrupted publish
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+        os.rename(output_path, old)
+    tmplink = output_path + ".tmp"
+    if os.path.lexists(tmplink):
+        os.remove(tmplink)
+    os.symlink(os.path.relpath(staging, os.path.dirname(output_path) or "."), tmplink)
+    os.replace(tmplink, output_path)
+    if old and old != os.path.realpath(staging):
+        shutil.rmtree(old, ignore_errors=True)
+
+def update_page(tree, path, **params):
+    """
+    Rebuild a single modified file of a previous build in this process 
+    and only the indexes and tag pages it is listed on if its meta data
+    or, as they may show its content, its source changed. If the tags or 
+    latest entries changed the pages whose template uses them are rebuilt
+    as well. Returns False if the file is not in the tree, i.e. it's new,
+    and a build is needed.
+    """
+    folder = tree
+    parts = os.path.relpath(path, params["input_path"]).split(os.sep)
+    for name in parts[:-1]:
+        folder = folder.get(name)
+        if not isinstance(folder, dict):
+            return False
+    file = folder.get(parts[-1])
+    if not isinstance(file, dict) or file["_type"] != "file":
+        return False
+
+    # record in the manifest of the previous build
+    params["_newmanifest"] = params["_manifest"]
+    old_entry = entry_key(file, **params)
+    old_state = {n: state_hash((n,), **params) for n in STATE_NAMES}
+    # start from the walked entry so no stale meta data remains
+    if isinstance(file, Node):
+        st = os.stat(path)
+        file.stat = FileStat(st.st_mtime, st.st_size)
+    for k in list(file):
+        if not k.startswith("_"):
+            del file[k]
+    scan_path(file, **params)
+    if transform_files([file], **params)[0]:
+        params["_images"] = []
+        parse_path(file, **params)
+        process_images(params.pop("_images"), **params)
+    if entry_key(file, **params) != old_entry:
+        # update the tags the file is listed on
+        changed = set()
+        for tag, entries in list(params["_tags"].items()):
+            if any(e is file for e in entries):
+                entries[:] = [e for e in entries if e is not file]
+                changed.add(tag)
+                if not entries:
+                    del params["_tags"][tag]
+        collect_tags(file, **params)
+        changed.update(t for t, entries in params["_tags"].items() if any(e is file for e in entries))
+        # keep the order of a build, the tags and their entries are 
+        # collected in the order of the walk
+        rank = {id(f): i for i, f in enumerate(tree_files(tree))}
+        for tag in changed & params["_tags"].keys():
+            params["_tags"][tag].sort(key=lambda e: rank.get(id(e), len(rank)))
+        tags = sorted(params["_tags"].items(), key=lambda item: (rank.get(id(item[1][0]), len(rank)),
+                                                                 file_tags(item[1][0]).index(item[0])))
+        params["_tags"].clear()
+        params["_tags"].update(tags)
+
+        params["_latest"][:] = latest_entries(tree, **params)
+        changed_state = {n for n in STATE_NAMES if state_hash((n,), **params) != old_state[n]}
+        if changed_state:
+            # the pages whose template uses the changed state are rendered
+            # again, indexes and tag pages which don't use it are current
+            for d in tree_dirs(tree):
+                for f in d.values():
+                    if isinstance(f, dict) and f["_type"] == "file" and \
+                       f["_ext"] in (".md", ".html") and template_state(page_template(f).name) & changed_state:
+                        parse_path(f, **params)
+                generate_index(d, **params)
+            if params["_tags"]:
+                generate_tags(params["_tags"], **params)
+        else:
+            generate_index(folder, **params)
+            if params["_tags"]:
+                generate_tags(params["_tags"], only=changed, **params)
+        generate_feeds(tree, **params)
+    if "post_build" in _hooks:
+        _hooks["post_build"](tree, **params)
+    compress_outputs(**params)
+    save_manifest(params["_manifest"], params["output_path"], params.get("cache_path", ".appie-cache"),
+                  params["input_path"])
+    del params["_newmanifest"]
+    return True
+
+def main():
+    params = site_params()
+    from_scratch = False
+    level = logging.INFO
+    for i, arg in enumerate(sys.argv):
+        if arg == "-f" :
+            from_scratch = True
+        if arg == "-h":
+            print(helpmsg)         
+            sys.exit(0)
+        if arg.startswith("-j"):
+            jobs = arg[2:]
+            if not jobs and sys.argv[i+1:i+2] and sys.argv[i+1].isdigit():
+                jobs = sys.argv[i+1]
+            if jobs and not jobs.isdigit():
+                print(helpmsg)
+                sys.exit(1)
+            params["jobs"] = int(jobs) if jobs else os.cpu_count()
+        if arg == "-s":
+            params["stage"] = True
+        if arg == "-v":
+            level = logging.DEBUG
+        if arg == "-q":
+            level = logging.WARNING
+        if arg in ("--profile", "--cprofile"):
+            params["_profile"] = new_profile()
+    
+    logging.basicConfig(format="%(message)s")
+    logger.setLevel(level)
+
+    if "--cprofile" in sys.argv:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    build(params, from_scratch)
+    total = time.perf_counter() - start
+    if "--cprofile" in sys.argv:
+        # only the main process is profiled, not the -j workers
+        profiler.disable()
+        profiler.dump_stats("appie-profile.prof")
+    if params.get("_profile") is not None:
+        report = profile_report(params["_profile"], total)
+        fwrite("appie-profile.json", json.dumps(report, indent=2))
+        logger.info("build took {:.3f}s, {}".format(total, ", ".join(
+              "{} {:.3f}s".format(p, t) for p, t in report["phases"].items())))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Benchmark for appie.py
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2025 Arnaud Loonstra
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Generate a synthetic site and time appie.py building it: a full build
+with cold and with warm caches, a rebuild without changes, a rebuild
+after editing the text of a page, after editing its title (which
+changes indexes and tag pages) and after replacing an image. Every build runs appie.py in a new
+process with --profile so we also get the time of every phase.
+
+The results are appended to a results file. A scenario which is slower
+than the fastest previous run of the same site size is reported as a
+regression.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam "
+         "quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo "
+         "consequat duis aute irure in reprehenderit voluptate velit esse cillum "
+         "fugiat nulla pariatur excepteur sint occaecat cupidatat non proident "
+         "sunt culpa qui officia deserunt mollit anim id est laborum").split()
+
+CODE = """    :::python
+    def fib(n):
+        \"\"\"Return the {0}th fibonacci number\"\"\"
+        a, b = 0, 1
+        for i in range(n):
+            a, b = b, a + b
+        return a + {0}
+"""
+
+# the scenarios in the order we run them
+SCENARIOS = ("full-cold", "full-warm", "noop", "edit-page", "edit-meta", "edit-image")
+
+def sentence(rnd, n=12):
+    return " ".join(rnd.choice(WORDS) for i in range(n)).capitalize() + "."
+
+def page_folder(i):
+    """Return the folder of the ith page, 3 levels deep with 100 pages per folder"""
+    parts = ["section{}".format(i % 10), "part{}".format(i // 10 % 10)]
+    if i // 100 % 2:
+        parts.append("deep{}".format(i // 1000))
+    return os.path.join("content", *parts)
+
+def make_page(rnd, i, image=None):
+    """Return the markdown of a page with front matter, a code block and maybe an image"""
+    date = datetime.date(2000, 1, 1) + datetime.timedelta(days=rnd.randrange(9000))
+    tags = sorted(set("tag{}".format(rnd.randrange(50)) for t in range(rnd.randint(1, 4))))
+    lines = ["title: Page {} {}".format(i, rnd.choice(WORDS)),
+             "date: {}".format(date.isoformat()),
+             "tags: {}".format(", ".join(tags)),
+             "",
+             sentence(rnd, 20),
+             ""]
+    if image:
+        lines += ["![{}]({})".format(image, image), ""]
+    for p in range(rnd.randint(2, 6)):
+        lines += ["## " + sentence(rnd, 4), "", sentence(rnd, 40), ""]
+    # separate code blocks by a paragraph so they're not merged
+    lines += [CODE.format(i % 100), "", sentence(rnd), ""]
+    return "\n".join(lines)
+
+def make_image(rnd, path):
+    """Write a noisy photo like image, noise doesn't compress well just like photos"""
+    w, h = rnd.choice(((1600, 1200), (1200, 1600), (2048, 1152)))
+    img = Image.merge("RGB", (Image.effect_noise((w, h), 48),
+                              Image.linear_gradient("L").resize((w, h)),
+                              Image.effect_noise((w, h), 24)))
+    if path.endswith(".png"):
+        img.save(path)
+    else:
+        img.save(path, quality=90)
+
+def generate_site(path, pages, images, seed=0):
+    """Generate a site with pages markdown pages and images images in path"""
+    rnd = random.Random(seed)
+    for d in ("templates", "static"):
+        shutil.copytree(os.path.join(ROOT, d), os.path.join(path, d))
+    # spread the images evenly over the pages
+    step = pages // images if images else 0
+    for i in range(pages):
+        folder = os.path.join(path, page_folder(i))
+        os.makedirs(folder, exist_ok=True)
+        image = None
+        if step and i % step == 0 and i // step < images:
+            image = "image{}.{}".format(i, "png" if i // step % 5 == 4 else "jpg")
+            make_image(rnd, os.path.join(folder, image))
+        with open(os.path.join(folder, "page{}.md".format(i)), 'w') as f:
+            f.write(make_page(rnd, i, image))
+
+def run_appie(site, *args):
+    """Run appie.py in the site dir, return the time it took and its phases"""
+    start = time.perf_counter()
+    # -q so the log of appie.py doesn't end up in our report
+    subprocess.run([sys.executable, os.path.join(ROOT, "appie.py"), "-q", "--profile", *args],
+                   cwd=site, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    with open(os.path.join(site, "appie-profile.json")) as f:
+        report = json.load(f)
+    return {"seconds": round(seconds, 3), "phases": report["phases"], "cache": report["cache"]}
+
+def run_scenarios(site, jobs=None):
+    """Run all scenarios on a generated site, returns their results"""
+    args = ["-j{}".format(jobs)] if jobs else []
+    page = os.path.join(site, page_folder(0), "page0.md")
+    results = {}
+    results["full-cold"] = run_appie(site, "-f", *args)
+    results["full-warm"] = run_appie(site, "-f", *args)
+    results["noop"] = run_appie(site, *args)
+    with open(page, 'a') as f:
+        f.write("\nAn extra paragraph.\n")
+    results["edit-page"] = run_appie(site, *args)
+    with open(page) as f:
+        title, text = f.read().split("\n", 1)
+    with open(page, 'w') as f:
+        f.write("title: Page 0 edited at {}\n".format(time.time()) + text)
+    results["edit-meta"] = run_appie(site, *args)
+    # the first page has the first image if the site has images
+    image = os.path.join(site, page_folder(0), "image0.jpg")
+    if os.path.isfile(image):
+        make_image(random.Random(time.time()), image)
+        results["edit-image"] = run_appie(site, *args)
+    return results
+
+def check_regressions(run, history, tolerance):
+    """Return the scenarios of run which are slower than the fastest comparable run"""
+    same = [h for h in history if all(h[k] == run[k] for k in ("pages", "images", "jobs"))]
+    regressions = []
+    for scenario, result in run["results"].items():
+        times = [h["results"][scenario]["seconds"] for h in same if scenario in h["results"]]
+        if not times:
+            continue
+        best = min(times)
+        # ignore noise on very fast scenarios
+        if result["seconds"] > best * (1 + tolerance) and result["seconds"] - best > 0.05:
+            regressions.append((scenario, best, result["seconds"]))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark appie.py on a generated site')
+    parser.add_argument('-n','--pages', help='number of markdown pages, e.g. 1000, 10000 or 100000', default=1000, type=int)
+    parser.add_argument('-i','--images', help='number of images (default: 1 per 100 pages)', default=None, type=int)
+    parser.add_argument('-j','--jobs', help='worker processes to pass to appie.py', default=None, type=int)
+    parser.add_argument('-o','--output', help='file to append the results to', default='bench-results.json')
+    parser.add_argument('-t','--tolerance', help='slowdown to report as a regression', default=0.2, type=float)
+    parser.add_argument('-k','--keep', help='keep the generated site in this dir', default=None)
+    args = parser.parse_args()
+    images = args.images if args.images is not None else args.pages // 100
+
+    site = args.keep or tempfile.mkdtemp(prefix="appie-bench-")
+    try:
+        if not os.path.isdir(os.path.join(site, "content")):
+            start = time.perf_counter()
+            generate_site(site, args.pages, images)
+            print("generated {} pages and {} images in {:.1f}s".format(
+                  args.pages, images, time.perf_counter() - start))
+        results = run_scenarios(site, args.jobs)
+    finally:
+        if not args.keep:
+            shutil.rmtree(site, ignore_errors=True)
+
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                            capture_output=True, text=True).stdout.strip()
+    run = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+           "commit": commit, "python": sys.version.split()[0], "pages": args.pages,
+           "images": images, "jobs": args.jobs, "results": results}
+    for scenario in (s for s in SCENARIOS if s in results):
+        r = results[scenario]
+        print("{:10} {:8.3f}s  {}".format(scenario, r["seconds"], ", ".join(
+              "{} {:.3f}s".format(p, t) for p, t in r["phases"].items() if t >= 0.001)))
+
+    history = []
+    if os.path.isfile(args.output):
+        with open(args.output) as f:
+            history = json.load(f)
+    regressions = check_regressions(run, history, args.tolerance)
+    history.append(run)
+    with open(args.output, 'w') as f:
+        json.dump(history, f, indent=1)
+    for scenario, best, seconds in regressions:
+        print("REGRESSION {}: {:.3f}s, best was {:.3f}s".format(scenario, seconds, best))
+    sys.exit(1 if regressions else 0)
@@ -17,49 +17,232 @@
 
 import argparse
 import logging
-import sys
 import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from threading import Timer
+from threading import Timer, Lock
+from queue import Queue, Empty
+import http.server
+import json
 import os
-import subprocess
-
-def run_appie():
-    command = "{} -u appie.py".format(sys.executable)
-    print("running: {} in {}".format(command, cwd))
-    try:
-        process = subprocess.Popen(command,shell=True,cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-
-        # Poll process.stdout to show stdout live
-        while True:
-          output = process.stdout.readline()
-          #err = process.stderr.readline()
-          if process.poll() is not None:
-            break
-          if output:
-            print(output.strip())
-          #if err:
-          #  print(err.strip())
-        rc = process.poll()
-    finally:
-        running = False
-    return rc
+import appie
+
+logger = logging.getLogger("appie.dev")
+
+# the endpoint pushing the changed urls and the script listening to it
+# which is added to every html page we serve. Browsers allow only a few
+# connections to a host so all tabs share one connection in a shared
+# worker, if the browser has them.
+EVENTS_URL = "/_appie/events"
+WORKER_URL = "/_appie/worker.js"
+WORKER = """var ports = [];
+new EventSource("{0}").onmessage = function(e) {{
+    ports.forEach(function(port) {{ port.postMessage(e.data); }});
+}};
+onconnect = function(e) {{ ports.push(e.ports[0]); }};
+""".format(EVENTS_URL)
+LIVE_RELOAD = """<script>
+(function() {{
+    function changed(data) {{
+        var path = decodeURI(location.pathname);
+        if (path.endsWith("/")) path += "index.html";
+        // reload if this page or an asset it might use changed
+        if (JSON.parse(data).some(function(url) {{
+            return url == path || /\\.(css|js|png|jpe?g|gif|svg|webp|avif|ico|woff2?)$/.test(url);
+        }})) location.reload();
+    }}
+    if (window.SharedWorker) {{
+        new SharedWorker("{1}").port.onmessage = function(e) {{ changed(e.data); }};
+    }} else {{
+        new EventSource("{0}").onmessage = function(e) {{ changed(e.data); }};
+    }}
+}})();
+</script>
+""".format(EVENTS_URL, WORKER_URL)
+
+class Builder:
+    """
+    Keeps the site (the tree, params and compiled templates) in memory 
+    and rebuilds only what is affected by the changed files
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.listeners = []
+        self.params = appie.site_params()
+        self.tree = None
+        self.build()
+
+    def build(self):
+        start = time.time()
+        self.tree = appie.build(self.params)
+        logger.info("build done in {:.3f}s".format(time.time() - start))
+
+    def rebuild(self, paths):
+        """Rebuild the site for the changed paths and notify the listeners"""
+        with self.lock:
+            start = time.time()
+            before = self.outputs()
+            content = os.path.normpath(self.params["input_path"]) + os.sep
+            full = False
+            static = False
+            pages = []
+            for path in paths:
+                path = os.path.relpath(path)
+                if path.startswith("static" + os.sep):
+                    static = True
+                    # the css inlined in every page
+                    if self.params.get("inline_css") and path.endswith(".css"):
+                        full = True
+                elif path.startswith(content) and os.path.isfile(path):
+                    pages.append(path)
+                else:
+                    # templates or new, moved or deleted content
+                    full = True
+            if static and not full:
+                self.sync_static()
+            if full:
+                self.tree = appie.build(self.params)
+            else:
+                for path in pages:
+                    if not appie.update_page(self.tree, path, **self.params):
+                        self.tree = appie.build(self.params)
+                        break
+            after = self.outputs()
+            changed = set(self.url(f) for f in before.keys() | after.keys() if before.get(f) != after.get(f))
+            self.notify(sorted(changed))
+            logger.info("rebuild of {} done in {:.3f}s".format(", ".join(sorted(paths)), 
+                                                         time.time() - start))
+
+    def outputs(self):
+        """Return the keys of the outputs and static files of the last build"""
+        manifest = self.params["_manifest"]
+        outputs = {f: rec["key"] for f, rec in manifest["outputs"].items()}
+        outputs.update((os.path.join(self.params["output_path"], path), rec)
+                       for path, rec in manifest["static"].items())
+        return outputs
+
+    def url(self, outfile):
+        """Return the url of an output file as served by the dev server"""
+        return "/" + os.path.relpath(outfile, self.params["output_path"]).replace(os.sep, "/")
+
+    def listen(self):
+        """Return a queue receiving the changed urls after every rebuild"""
+        q = Queue()
+        with self.lock:
+            self.listeners.append(q)
+        return q
+
+    def unlisten(self, q):
+        with self.lock:
+            self.listeners.remove(q)
+
+    def notify(self, urls):
+        if urls:
+            for q in self.listeners:
+                q.put(urls)
+
+    def sync_static(self):
+        """Sync the static dir to the output dir"""
+        self.params["_newmanifest"] = self.params["_manifest"]
+        appie.sync_static(**self.params)
+        appie.save_manifest(self.params["_manifest"], self.params["output_path"],
+                            self.params.get("cache_path", ".appie-cache"), self.params["input_path"])
+        del self.params["_newmanifest"]
 
 class WatchEventHandler(FileSystemEventHandler):
 
-    timer = None
+    def __init__(self, builder, delay=0.1, only=None):
+        self.builder = builder
+        self.delay = delay
+        # if given only these files are watched
+        self.only = only
+        self.timer = None
+        self.paths = set()
+        self.lock = Lock()
         
     def on_any_event(self, event, *args, **kwargs):
-        if event.event_type != "opened":
+        if event.event_type in ("opened", "closed", "closed_no_write"):
+            return
+        if event.is_directory and event.event_type == "modified":
+            return
+        with self.lock:
+            for path in (event.src_path, getattr(event, "dest_path", None)):
+                # skip editor swap and backup files
+                if path and not os.path.basename(path).startswith(".") and not path.endswith("~"):
+                    if self.only is None or os.path.abspath(path) in self.only:
+                        self.paths.add(path)
+            if not self.paths:
+                return
             # Cancel the previous timer if it exists
-            print(WatchEventHandler.timer)
-            if WatchEventHandler.timer:
-                WatchEventHandler.timer.cancel()
-            # Create a new timer to execute the command after a delay
-            WatchEventHandler.timer = Timer(1.0, run_appie)
-            WatchEventHandler.timer.start()
-        
+            if self.timer:
+                self.timer.cancel()
+            # Create a new timer to rebuild after a short delay so we
+            # handle a burst of events at once
+            self.timer = Timer(self.delay, self.rebuild)
+            self.timer.start()
+
+    def rebuild(self):
+        with self.lock:
+            paths, self.paths = self.paths, set()
+        if paths:
+            self.builder.rebuild(paths)
+
+class DevRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the site with the live reload script added to the html pages
+    and pushes the changed urls to the browser using Server-Sent Events
+    """
+
+    def __init__(self, *args, builder=None, **kwargs):
+        self.builder = builder
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        if self.path == EVENTS_URL:
+            return self.send_events()
+        if self.path == WORKER_URL:
+            return self.send_text(WORKER, "application/javascript")
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split("?")[0].endswith("/"):
+            path = os.path.join(path, "index.html")
+        if not path.endswith(".html") or not os.path.isfile(path):
+            return super().do_GET()
+        html = appie.fread(path)
+        # add the script to the end of the body
+        i = html.rfind("</body>")
+        html = html[:i] + LIVE_RELOAD + html[i:] if i >= 0 else html + LIVE_RELOAD
+        self.send_text(html, "text/html")
+
+    def send_text(self, text, content_type):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        q = self.builder.listen()
+        try:
+            while True:
+                try:
+                    data = "data: {}\n\n".format(json.dumps(q.get(timeout=15)))
+                except Empty:
+                    # keep the connection alive and detect closed tabs
+                    data = ": ping\n\n"
+                self.wfile.write(data.encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.builder.unlisten(q)
+
         
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Dev server for Appie2 Static HTML generator')
@@ -67,35 +250,34 @@ if __name__ == '__main__':
     parser.add_argument('-p','--port', help='port for the http server', default=8000, type=int, required=False)
     parser.add_argument('-v','--verbose', help="verbose output", default=False, required=False, action='store_true')
     args = vars(parser.parse_args())
-    if args.get('verbose'):
-        logging.basicConfig(level=logging.DEBUG)
+    logging.basicConfig(format="%(message)s")
+    appie.logger.setLevel(logging.DEBUG if args.get('verbose') else logging.INFO)
     
-    # generate the site
-    run_appie()
+    # generate the site and keep it in memory
+    builder = Builder()
 
     # serve files if requested
     if args.get('www'):
-        import http.server
-        import socketserver
-        import os
-        import select
-        
-        class Handler(http.server.SimpleHTTPRequestHandler):
+        class Handler(DevRequestHandler):
             def __init__(self, *args, **kwargs):
-                super().__init__(*args, directory="./_site", **kwargs)
+                super().__init__(*args, builder=builder, directory=builder.params["output_path"], **kwargs)
         
         # setup filesystem watches
         observer = Observer()
+        handler = WatchEventHandler(builder)
         for path in ('./content', './static', './templates'):
-            observer.schedule(WatchEventHandler(), path, recursive=True)
+            observer.schedule(handler, path, recursive=True)
+        # a changed plugins file is loaded again by a full build
+        plugins = os.path.abspath(builder.params.get("plugins", "plugins.py"))
+        observer.schedule(WatchEventHandler(builder, only={plugins}), 
+                          os.path.dirname(plugins), recursive=False)
         observer.start()
         
         # setup http server
-        #os.chdir("_site") #
         PORT = args.get('port')
-        with socketserver.TCPServer(("", PORT), Handler) as httpd:
-            httpd.allow_reuse_address = True
-            print("Serving on port {0}...     press CTRL-C to quit".format(PORT))
+        http.server.ThreadingHTTPServer.allow_reuse_address = True
+        with http.server.ThreadingHTTPServer(("", PORT), Handler) as httpd:
+            logger.info("Serving on port {0}...     press CTRL-C to quit".format(PORT))
             httpd.serve_forever()
                     
         observer.stop()
@@ -1,6 +1,14 @@
 import unittest
 import os
-from appie import walk_directory, parse_path, parse_dir
+import copy
+import shutil
+import tempfile
+from appie import walk_directory, parse_path, parse_dir, parse_files, generate_tags, collect_tags, \
+                  sort_entries, generate_index, scan_path, find_template, template_hash, new_manifest, image_size, fit_size, image_variants, IMAGE_VARIANTS, \
+                  get_markdown, prune_cache, build, update_page, sync_static, \
+                  new_profile, profile_report, copy_source, process_assets, minify_html, minify_css, \
+                  extract_meta, load_manifest
+import appie
 
 from pprint import pprint
 
@@ -81,7 +89,6 @@ rettgt2 = {'.': {'_path': '.',
                           'authors': ['Waylan Limberg', 'John Doe'],
                           'base_url': 'http://example.com',
                           'blank-value': '',
-                          'content': '<p>This is the first paragraph of the document.</p>',
                           'date': 'October 2, 2007',
                           'summary': 'A brief description of my document.',
                           'title': 'My Document',
@@ -98,7 +105,6 @@ rettgt3 = {'_path': '',
                   '_sitepath': 'bla.md',
                   '_srcpath': './test/bla.md',
                   '_type': 'file',
-                  'content': '',
                   'summary': None,
                   'url': 'bla.html'},
        'test.png': {'_ext': '.png',
@@ -125,8 +131,6 @@ rettgt3 = {'_path': '',
                          'authors': ['Waylan Limberg', 'John Doe'],
                          'base_url': 'http://example.com',
                          'blank-value': '',
-                         'content': '<p>This is the first paragraph of the '
-                                    'document.</p>',
                          'date': 'October 2, 2007',
                          'summary': 'A brief description of my document.',
                          'title': 'My Document',
@@ -142,7 +146,6 @@ rettgt4 = {'_path': '',
                   '_sitepath': 'bla.md',
                   '_srcpath': './test/bla.md',
                   '_type': 'file',
-                  'content': '',
                   'summary': None,
                   'url': 'bla.html'},
        'test.png': {'_ext': '.png',
@@ -152,9 +155,14 @@ rettgt4 = {'_path': '',
                     '_sitepath': 'test.png',
                     '_srcpath': './test/test.png',
                     '_type': 'file',
-                    'md5': 'todo',
+                    'md5': '777421072769069baea29f4e91118172',
                     'mimetype': 'image/png',
                     'size': (200, 200),
+                    'srcset': {'image/jpeg': '/test_web.jpg 200w, /test_thumb.jpg 200w'},
+                    'variants': [{'height': 200, 'mimetype': 'image/jpeg', 'name': 'web',
+                                  'url': 'test_web.jpg', 'width': 200},
+                                 {'height': 200, 'mimetype': 'image/jpeg', 'name': 'thumb',
+                                  'url': 'test_thumb.jpg', 'width': 200}],
                     'thumb': 'test_thumb.jpg',
                     'web': 'test_web.jpg'},
         'testdir': {'_path': 'testdir',
@@ -167,9 +175,15 @@ rettgt4 = {'_path': '',
                           '_srcpath': './test/testdir/test.jpg',
                           '_type': 'file',
                           'url': 'testdir/test.jpg',
-                          'md5': 'todo',
+                          'md5': 'db2a0dd884d3d01505ef80020c31f802',
                           'mimetype': 'image/jpg',
                           'size': (200, 200),
+                          'srcset': {'image/jpeg': '/testdir/test_web.jpg 200w, '
+                                                   '/testdir/test_thumb.jpg 200w'},
+                          'variants': [{'height': 200, 'mimetype': 'image/jpeg', 'name': 'web',
+                                        'url': 'testdir/test_web.jpg', 'width': 200},
+                                       {'height': 200, 'mimetype': 'image/jpeg', 'name': 'thumb',
+                                        'url': 'testdir/test_thumb.jpg', 'width': 200}],
                           'thumb': 'test_thumb.jpg',
                           'web': 'test_web.jpg'},
              'test.md': {'_ext': '.md',
@@ -181,8 +195,6 @@ rettgt4 = {'_path': '',
                          'authors': ['Waylan Limberg', 'John Doe'],
                          'base_url': 'http://example.com',
                          'blank-value': '',
-                         'content': '<p>This is the first paragraph of the '
-                                    'document.</p>',
                          'date': 'October 2, 2007',
                          'summary': 'A brief description of my document.',
                          'title': 'My Document',
@@ -206,6 +218,12 @@ def remove_mtime(d):
             remove_mtime(d[k])
         elif k == "_mtime":
             del d[k]       
+def copy_content():
+    """Return a copy of the test content dir which a test can change"""
+    path = os.path.join(tempfile.mkdtemp(), "test")
+    shutil.copytree("./test", path)
+    return path
+
 params = {
         'base_path': '/',
         'output_path': '_site',
@@ -249,6 +267,489 @@ class AppieTest(unittest.TestCase):
 
         checkdir(rettgt)
 
+    def test5_manifest(self):
+        tree = walk_directory("./test", **params)
+        file = copy.deepcopy(tree["testdir"]["test.md"])
+        p = dict(params, _manifest=new_manifest(), _newmanifest=new_manifest())
+        parse_path(file, **p)
+        outfile = os.path.join("_site", "testdir", "test.html")
+        self.assertIn(outfile, p["_newmanifest"]["outputs"])
+        # unchanged inputs must not regenerate the page
+        with open(outfile, 'w') as f:
+            f.write("untouched")
+        p = dict(params, _manifest=p["_newmanifest"], _newmanifest=new_manifest())
+        file = copy.deepcopy(tree["testdir"]["test.md"])
+        parse_path(file, **p)
+        with open(outfile) as f:
+            self.assertEqual(f.read(), "untouched")
+        self.assertEqual(file["summary"], "A brief description of my document.")
+        self.assertNotIn("content", file)
+        # a changed parameter must regenerate it
+        p = dict(params, subtitle="changed", _manifest=p["_newmanifest"], _newmanifest=new_manifest())
+        parse_path(copy.deepcopy(tree["testdir"]["test.md"]), **p)
+        with open(outfile) as f:
+            self.assertNotEqual(f.read(), "untouched")
+        # as must a new tag, default.html uses _tags
+        with open(outfile, 'w') as f:
+            f.write("untouched")
+        p = dict(params, subtitle="changed", _tags={"brandnew": []},
+                 _manifest=p["_newmanifest"], _newmanifest=new_manifest())
+        parse_path(copy.deepcopy(tree["testdir"]["test.md"]), **p)
+        with open(outfile) as f:
+            self.assertNotEqual(f.read(), "untouched")
+        # the meta data of a latest entry is part of the state, not only its url
+        src = copy_content()
+        latest = walk_directory(src, **params)["testdir"]["test.md"]
+        latest["url"] = "testdir/test.html"
+        state = appie.state_hash(**dict(params, _latest=[latest]))
+        with open(latest["_srcpath"], 'a') as f:
+            f.write("\nAnother paragraph.\n")
+        latest = walk_directory(src, **params)["testdir"]["test.md"]
+        latest["url"] = "testdir/test.html"
+        self.assertNotEqual(appie.state_hash(**dict(params, _latest=[latest])), state)
+
+    def test6_parse_files_jobs(self):
+        tree = walk_directory("./test", **params)
+        serial = [copy.deepcopy(tree["bla.md"]), copy.deepcopy(tree["testdir"]["test.md"])]
+        parallel = copy.deepcopy(serial)
+        parse_files(serial, **dict(params, _tags={}))
+        parse_files(parallel, **dict(params, _tags={}, jobs=2))
+        self.assertEqual(serial, parallel)
+        # the dropped content of a page rendered in a worker can be loaded again
+        self.assertEqual(parallel[1]["content"], serial[1]["content"])
+        # a worker keeps the template hashes of its parent
+        appie._init_worker(dict(params, _newmanifest=dict(new_manifest(), templates={"default.html": "x"})))
+        try:
+            manifest = appie._parse_worker(copy.deepcopy(tree["bla.md"]))[1]
+        finally:
+            appie._worker_params = None
+        self.assertEqual(manifest["templates"], {"default.html": "x"})
+
+    def test7_image_size(self):
+        p = dict(params, _manifest=new_manifest(), _newmanifest=new_manifest())
+        self.assertEqual(image_size("./test/test.png", **p), (200, 200))
+        # an unchanged image is not opened again
+        rec = p["_newmanifest"]["images"]["./test/test.png"]
+        rec[2] = [1, 1]
+        p = dict(params, _manifest=p["_newmanifest"], _newmanifest=new_manifest())
+        self.assertEqual(image_size("./test/test.png", **p), (1, 1))
+
+    def test8_image_variants(self):
+        variants = image_variants(image_variants=[{"name": "small", "width": 480, "format": "webp"},
+                                                  {"name": "large", "width": 960, "format": "jpeg"}])
+        self.assertEqual([v["name"] for v in variants], ["large", "small"])
+        self.assertEqual(fit_size((1920, 1080), variants[1]), (480, 270))
+        self.assertEqual(fit_size((200, 100), variants[1]), (200, 100))
+        self.assertEqual(fit_size((4000, 3000), IMAGE_VARIANTS[0]), (960, 720))
+        # generated images no output links to are pruned first
+        p = dict(params, input_path="./test", output_path="_site/imgcache", cache_path=tempfile.mkdtemp())
+        build(p, from_scratch=True)
+        cache = os.path.join(p["cache_path"], "images")
+        linked = [os.path.join(d, f) for d in os.listdir(cache) for f in os.listdir(os.path.join(cache, d))]
+        os.makedirs(os.path.join(cache, "00"))
+        with open(os.path.join(cache, "00", "00.jpg"), 'w') as f:
+            f.write("unused")
+        prune_cache("images", len(linked), **p)
+        self.assertFalse(os.path.exists(os.path.join(cache, "00", "00.jpg")))
+        self.assertTrue(all(os.path.exists(os.path.join(cache, f)) for f in linked))
+
+    def test9_markdown_cache(self):
+        self.assertIs(get_markdown(), get_markdown())
+        self.assertEqual(get_markdown().convert("# a").count("h1"), 2)
+        self.assertEqual(get_markdown().Meta, {})
+        tree = walk_directory("./test", **params)
+        p = dict(params, cache_path="_site/.cache")
+        parse_path(tree["testdir"]["test.md"], **p)
+        cached = os.listdir("_site/.cache/markdown")
+        self.assertEqual(len(cached), 1)
+        # a cached document gives the same result
+        file = walk_directory("./test", **params)["testdir"]["test.md"]
+        parse_path(file, **p)
+        self.assertEqual(file, tree["testdir"]["test.md"])
+        # a new pygments version doesn't reuse the cached html
+        key = appie.markdown_key(file, **p)
+        version, appie.pygments_version = appie.pygments_version, "0"
+        try:
+            self.assertNotEqual(appie.markdown_key(file, **p), key)
+        finally:
+            appie.pygments_version = version
+
+    def test10_highlight_cache(self):
+        doc = "\n\n".join("code:\n\n    :::python\n    x = {}".format(i) for i in range(3))
+        def entries():
+            return [f for d in os.listdir("_site/.cache/highlight")
+                    for f in os.listdir(os.path.join("_site/.cache/highlight", d))]
+        html = get_markdown(cache_path="_site/.cache").convert(doc)
+        self.assertEqual(len(entries()), 3)
+        self.assertEqual(get_markdown(cache_path="_site/.cache").convert(doc), html)
+        prune_cache("highlight", 1, cache_path="_site/.cache")
+        self.assertEqual(len(entries()), 1)
+
+    def test11_tags(self):
+        p = dict(params, _tags={}, _manifest=new_manifest(), _newmanifest=new_manifest())
+        collect_tags({"url": "a.html", "tags": "one, two"}, **p)
+        collect_tags({"url": "b.html", "summary": "b", "tags": ["two"]}, **p)
+        self.assertEqual(sorted(p["_tags"]), ["one", "two"])
+        generate_tags(p["_tags"], **p)
+        outfile = os.path.join("_site", "tags", "one.html")
+        with open(outfile, 'w') as f:
+            f.write("untouched")
+        # only tags whose entries changed are rendered again
+        p.update(_manifest=p["_newmanifest"], _newmanifest=new_manifest())
+        p["_tags"]["two"][1]["title"] = "Title B"
+        generate_tags(p["_tags"], **p)
+        with open(outfile) as f:
+            self.assertEqual(f.read(), "untouched")
+        with open(os.path.join("_site", "tags", "two.html")) as f:
+            self.assertIn("Title B", f.read())
+        # a new tag only renders the other tag pages if the template uses _tags
+        import jinja2
+        loader = appie.env.loader
+        appie.env.loader = jinja2.ChoiceLoader([jinja2.DictLoader({"tags_index.html": "{{ title }}"}), loader])
+        appie.reset_templates(**p)
+        try:
+            p.update(_manifest=p["_newmanifest"], _newmanifest=new_manifest())
+            generate_tags(p["_tags"], **p)
+            with open(outfile, 'w') as f:
+                f.write("untouched")
+            p.update(_manifest=p["_newmanifest"], _newmanifest=new_manifest())
+            collect_tags({"url": "c.html", "tags": "three"}, **p)
+            generate_tags(p["_tags"], **p)
+        finally:
+            appie.env.loader = loader
+            appie.reset_templates(**p)
+        with open(outfile) as f:
+            self.assertEqual(f.read(), "untouched")
+        self.assertTrue(os.path.exists(os.path.join("_site", "tags", "three.html")))
+        # index pages may show the content of an entry so it's part of the key
+        src = copy_content()
+        p = dict(params, input_path=src, output_path="_site/entrykey")
+        build(p, from_scratch=True)
+        outfile = os.path.join("_site", "entrykey", "testdir", "index.html")
+        with open(outfile, 'w') as f:
+            f.write("untouched")
+        with open(os.path.join(src, "testdir", "test.md"), 'a') as f:
+            f.write("\nAn extra paragraph.\n")
+        build(p)
+        with open(outfile) as f:
+            self.assertNotEqual(f.read(), "untouched")
+
+    def test12_index_pages(self):
+        entries = [{"_type": "file", "_filename": "a", "date": "October 2, 2007"},
+                   {"_type": "file", "_filename": "b"},
+                   {"_type": "file", "_filename": "c", "date": "2024-01-31"},
+                   {"_type": "file", "_filename": "d", "date": "02-23-2023"}]
+        self.assertEqual([e["_filename"] for e in sort_entries(entries)], ["c", "d", "a", "b"])
+        # a date of several lines isn't a date
+        self.assertEqual([e["_filename"] for e in sort_entries(entries + [{"_filename": "e", "date": ["1", "2"]}])],
+                         ["c", "d", "a", "b", "e"])
+        folder = {"_path": "pages", "_srcpath": "./test/pages", "_type": "dir"}
+        folder.update((e["_filename"], e) for e in entries)
+        generate_index(folder, **dict(params, page_size={"pages": 3}))
+        self.assertTrue(os.path.exists(os.path.join("_site", "pages", "index.html")))
+        self.assertTrue(os.path.exists(os.path.join("_site", "pages", "page", "2.html")))
+        self.assertFalse(os.path.exists(os.path.join("_site", "pages", "page", "3.html")))
+
+    def test13_scan_path(self):
+        file = walk_directory("./test", **params)["testdir"]["test.md"]
+        scan_path(file, **params)
+        self.assertEqual(file["title"], "My Document")
+        self.assertEqual(file["authors"], ["Waylan Limberg", "John Doe"])
+        self.assertEqual(file["url"], "testdir/test.html")
+        self.assertNotIn("content", file)
+
+    def test14_templates(self):
+        tpl = find_template("nonexisting.html", "default.html")
+        self.assertEqual(tpl.name, "default.html")
+        self.assertIs(find_template("nonexisting.html", "default.html"), tpl)
+        # a template's hash includes the templates it extends
+        p = dict(params, _newmanifest=new_manifest())
+        template_hash("default.html", **p)
+        self.assertIn("base.html", p["_newmanifest"]["templates"])
+        # pages only depend on the part of the build state their template uses
+        self.assertEqual(appie.template_state("default.html"), {"_tags"})
+        latest = walk_directory("./test", **params)["bla.md"]
+        self.assertEqual(appie.state_hash({"_tags"}, **params),
+                         appie.state_hash({"_tags"}, **dict(params, _latest=[latest])))
+        self.assertIsNone(appie.state_hash(frozenset(), **params))
+
+    def test15_update_page(self):
+        src = copy_content()
+        source = os.path.join(src, "testdir", "test.md")
+        p = dict(params, nav=["testdir"], input_path=src, output_path="_site/update")
+        tree = build(p)
+        outfile = os.path.join("_site", "update", "bla.html")
+        with open(outfile, 'w') as f:
+            f.write("untouched")
+        self.assertTrue(update_page(tree, source, **p))
+        with open(outfile) as f:
+            self.assertEqual(f.read(), "untouched")
+        with open(os.path.join("_site", "update", "testdir", "test.html")) as f:
+            self.assertIn("My Document", f.read())
+        # the index shows the content so an edit of the body regenerates it
+        index = os.path.join("_site", "update", "testdir", "index.html")
+        with open(index, 'w') as f:
+            f.write("untouched")
+        with open(source, 'a') as f:
+            f.write("\nAnother paragraph.\n")
+        self.assertTrue(update_page(tree, source, **p))
+        with open(index) as f:
+            self.assertNotEqual(f.read(), "untouched")
+        # a new tag renders the pages whose template shows the tags again
+        with open(source) as f:
+            text = f.read()
+        with open(source, 'w') as f:
+            f.write("tags: brandnew\n" + text)
+        self.assertTrue(update_page(tree, source, **p))
+        with open(outfile) as f:
+            self.assertNotEqual(f.read(), "untouched")
+        # so a build doesn't find any stale outputs
+        outputs = {f: rec["key"] for f, rec in p["_manifest"]["outputs"].items()}
+        build(p)
+        self.assertEqual({f: rec["key"] for f, rec in p["_manifest"]["outputs"].items()}, outputs)
+        # an edit of the body keeps the order of the tags and their entries
+        with open(os.path.join(src, "bla.md"), 'w') as f:
+            f.write("tags: brandnew, other\n\nBla.\n")
+        tree = build(p)
+        def tags():
+            return [(tag, [e["url"] for e in entries]) for tag, entries in p["_tags"].items()]
+        order = tags()
+        outputs = {f: rec["key"] for f, rec in p["_manifest"]["outputs"].items()}
+        for path in (source, os.path.join(src, "bla.md")):
+            with open(path, 'a') as f:
+                f.write("\nA typo.\n")
+            self.assertTrue(update_page(tree, path, **p))
+            self.assertEqual(tags(), order)
+        tagindex = os.path.join("_site", "update", "tags", "index.html")
+        self.assertEqual(p["_manifest"]["outputs"][tagindex]["key"], outputs[tagindex])
+        # new files need a build
+        self.assertFalse(update_page(tree, os.path.join(src, "new.md"), **p))
+
+    def test16_sync_static(self):
+        p = dict(params, output_path="_site/static", _manifest=new_manifest(), _newmanifest=new_manifest())
+        changed = sync_static(**p)
+        self.assertTrue(changed)
+        with open(changed[0], 'w') as f:
+            f.write("untouched")
+        # unchanged files are not copied again, removed files are pruned
+        p.update(_manifest=p["_newmanifest"], _newmanifest=new_manifest())
+        p["_manifest"]["static"]["removed.txt"] = [0, 0]
+        with open(os.path.join("_site", "static", "removed.txt"), 'w') as f:
+            f.write("removed")
+        self.assertEqual(sync_static(**p), [os.path.join("_site", "static", "removed.txt")])
+        with open(changed[0]) as f:
+            self.assertEqual(f.read(), "untouched")
+        self.assertFalse(os.path.exists(os.path.join("_site", "static", "removed.txt")))
+
+    def test17_staged_build(self):
+        src = copy_content()
+        p = dict(params, input_path=src, output_path="_site/staged", stage=True)
+        with open(os.path.join(src, "orphan.md"), 'w') as f:
+            f.write("title: Orphan\n\nremoved before the next build")
+        build(p)
+        os.remove(os.path.join(src, "orphan.md"))
+        self.assertTrue(os.path.islink(os.path.join("_site", "staged")))
+        self.assertTrue(os.path.exists(os.path.join("_site", "staged", "orphan.html")))
+        # the outputs of removed content are pruned
+        build(p)
+        self.assertFalse(os.path.exists(os.path.join("_site", "staged", "orphan.html")))
+        self.assertTrue(os.path.exists(os.path.join("_site", "staged", "bla.html")))
+        # a leftover of an interrupted publish doesn't stop the next one
+        for d in ("pub", "pub.old", "pub.new"):
+            os.makedirs(os.path.join("_site", d), exist_ok=True)
+            with open(os.path.join("_site", d, "index.html"), 'w') as f:
+                f.write(d)
+        appie.publish_output(os.path.join("_site", "pub.new"), os.path.join("_site", "pub"))
+        with open(os.path.join("_site", "pub", "index.html")) as f:
+            self.assertEqual(f.read(), "pub.new")
+
+    def test18_compress(self):
+        import gzip
+        p = dict(params, input_path="./test", output_path="_site/compress", compress=["gzip"])
+        build(p, from_scratch=True)
+        outfile = os.path.join("_site", "compress", "bla.html")
+        with open(outfile, 'rb') as f, open(outfile + ".gz", 'rb') as gz:
+            self.assertEqual(gzip.decompress(gz.read()), f.read())
+        # outputs written with the same content are not compressed again
+        with open(outfile + ".gz", 'w') as f:
+            f.write("untouched")
+        os.utime(outfile)
+        build(p)
+        with open(outfile + ".gz") as f:
+            self.assertEqual(f.read(), "untouched")
+        # turning compression off removes the siblings
+        del p["compress"]
+        build(p)
+        self.assertFalse(os.path.exists(outfile + ".gz"))
+
+    def test19_profile(self):
+        p = dict(params, input_path="./test", output_path="_site/profile", _profile=new_profile())
+        build(p, from_scratch=True)
+        report = profile_report(p["_profile"], 1.0, top=1)
+        self.assertIn("walk", report["phases"])
+        self.assertIn("markdown", report["phases"])
+        self.assertEqual(len(report["slowest_pages"]), 1)
+        self.assertEqual(report["cache"]["pages"]["misses"], 2)
+
+    def test20_node_content(self):
+        file = walk_directory("./test", **params)["testdir"]["test.md"]
+        # only the mtime and size of the stat are kept
+        self.assertEqual(file.stat, (os.stat("./test/testdir/test.md").st_mtime,
+                                     os.stat("./test/testdir/test.md").st_size))
+        parse_path(file, **params)
+        # the content is dropped once the page is written but loaded when used
+        self.assertNotIn("content", file)
+        self.assertEqual(file["content"], "<p>This is the first paragraph of the document.</p>")
+        with self.assertRaises(KeyError):
+            file["nonexisting"]
+
+    def test21_assets(self):
+        file = walk_directory("./test", **params)["bla.md"]
+        p = dict(params, _assets=[], _manifest=new_manifest(), _newmanifest=new_manifest())
+        outfile = os.path.join("_site", "assets", "bla.md")
+        copy_source(file, outfile, **p)
+        self.assertEqual(p["_assets"], [("./test/bla.md", outfile)])
+        process_assets(p["_assets"], **p)
+        self.assertTrue(os.path.exists(outfile))
+        # unchanged files are not copied again
+        p.update(_assets=[], _manifest=p["_newmanifest"], _newmanifest=new_manifest())
+        copy_source(file, outfile, **p)
+        self.assertEqual(p["_assets"], [])
+        # images, assets and compression run on threads with -j as well
+        src = copy_content()
+        with open(os.path.join(src, "notes.txt"), 'w') as f:
+            f.write("an asset")
+        p = dict(params, input_path=src, output_path="_site/jobs", jobs=2, compress=["gzip"])
+        build(p, from_scratch=True)
+        self.assertTrue(os.path.exists(os.path.join("_site", "jobs", "notes.txt")))
+        self.assertTrue(os.path.exists(os.path.join("_site", "jobs", "test_web.jpg")))
+        self.assertTrue(os.path.exists(os.path.join("_site", "jobs", "testdir", "test_web.jpg")))
+        self.assertTrue(os.path.exists(os.path.join("_site", "jobs", "bla.html.gz")))
+
+    def test22_feeds_sitemap(self):
+        p = dict(params, input_path="./test", output_path="_site/feeds", feeds=["testdir"],
+                 sitemap=True, site_url="http://example.com")
+        build(p, from_scratch=True)
+        with open(os.path.join("_site", "feeds", "testdir", "feed.xml")) as f:
+            feed = f.read()
+        self.assertIn("<link href=\"http://example.com/testdir/test.html\"/>", feed)
+        self.assertIn("<author><name>http://example.com</name></author>", feed)
+        self.assertNotIn("<updated></updated>", feed)
+        with open(os.path.join("_site", "feeds", "sitemap.xml")) as f:
+            self.assertIn("<loc>http://example.com/bla.html</loc>", f.read())
+        # large sitemaps are split and listed in a sitemap index
+        size, appie.SITEMAP_SIZE = appie.SITEMAP_SIZE, 2
+        try:
+            build(p)
+        finally:
+            appie.SITEMAP_SIZE = size
+        with open(os.path.join("_site", "feeds", "sitemap.xml")) as f:
+            self.assertIn("<sitemap><loc>http://example.com/sitemap-2.xml</loc></sitemap>", f.read())
+        self.assertTrue(os.path.exists(os.path.join("_site", "feeds", "sitemap-1.xml")))
+
+    def test23_minify(self):
+        html = "<div>\n  <p>some   text <!-- note -->\n  <a>link</a> </p>\n" \
+               "<div class=\"codehilite\"><pre>  keep\n    this  </pre></div>\n</div>"
+        self.assertEqual(minify_html(html), "<div><p>some text\n<a>link</a></p>"
+                         "<div class=\"codehilite\"><pre>  keep\n    this  </pre></div></div>")
+        self.assertEqual(minify_css("a > b {\n  color: red; /* red */\n}\n"), "a>b{color:red}")
+        self.assertEqual(minify_css("a::after {\n  content: \"a , b;  c /* d */\";\n}"),
+                         "a::after{content:\"a , b;  c /* d */\"}")
+        p = dict(params, input_path="./test", output_path="_site/minify", minify=True, inline_css=True)
+        build(p, from_scratch=True)
+        with open(os.path.join("_site", "minify", "bla.html")) as f:
+            self.assertIn("<style>body{max-width:800px;", f.read())
+
+    def test24_plugins(self):
+        plugin = os.path.join(tempfile.mkdtemp(), "plugins.py")
+        with open(plugin, 'w') as f:
+            f.write("def transform(file, **params):\n"
+                    "    file['plugin'] = 'yes'\n"
+                    "    if file['_ext'] == '.md':\n"
+                    "        file['title'] = 'PLUGIN'\n"
+                    "    return file['_ext'] == '.png'\n"
+                    "transform.pure = True\n"
+                    "transform.cacheable = True\n"
+                    "def post_render(file, html, **params):\n"
+                    "    return html + '<!-- ' + file['plugin'] + ' -->'\n"
+                    "post_render.pure = True\n"
+                    "post_render.cacheable = True\n")
+        p = dict(params, input_path="./test", output_path="_site/plugins", plugins=plugin)
+        try:
+            build(p, from_scratch=True)
+            with open(os.path.join("_site", "plugins", "bla.html")) as f:
+                self.assertTrue(f.read().endswith("<!-- yes -->"))
+            # the meta data of the plugin wins over the front matter
+            with open(os.path.join("_site", "plugins", "testdir", "test.html")) as f:
+                self.assertIn("<title>PLUGIN -", f.read())
+            # the plugin handled the image
+            self.assertFalse(os.path.exists(os.path.join("_site", "plugins", "test_web.jpg")))
+            # the results of cacheable hooks are saved for the next build
+            rec = p["_manifest"]["plugins"]["./test/bla.md"]
+            self.assertFalse(rec[1])
+            self.assertEqual(rec[2]["plugin"], "yes")
+            # the meta data of a removed plugin isn't restored
+            os.remove(plugin)
+            build(p)
+            self.assertNotIn("plugin", p["_manifest"]["meta"]["./test/testdir/test.md"][1])
+            build(p, from_scratch=True)
+            self.assertNotIn("plugin", p["_manifest"]["meta"]["./test/testdir/test.md"][1])
+            # a value which can't be saved as json isn't kept
+            with open(plugin, 'w') as f:
+                f.write("import datetime\n"
+                        "def transform(file, **params):\n"
+                        "    file['published'] = datetime.date(2024, 1, 31)\n"
+                        "transform.cacheable = True\n")
+            build(p)
+            self.assertNotIn("./test/testdir/test.md", p["_manifest"]["meta"])
+            self.assertNotIn("./test/testdir/test.md", p["_manifest"]["plugins"])
+            build(p)
+            self.assertIn(os.path.join("_site", "plugins", "testdir", "test.html"), p["_manifest"]["outputs"])
+        finally:
+            # forget the hooks
+            appie.load_plugins()
+
+    def test25_extract_meta(self):
+        html = "<!-- title: Page -->\n<div><img src=\"a.png\"></div><p>The <em>first</em></p><p><img src=\"b.png\"></p>"
+        self.assertEqual(extract_meta(html), {"title": "Page", "thumbnail": "a.png", 
+                                              "summary": "The <em>first</em>"})
+        # markdown finds them while converting, in the same order as in the html
+        md = get_markdown()
+        html = md.convert("    code\n\n<div><img src=\"raw.png\"></div>\n\n"
+                          "Some \\*text\\* & <b>more</b>\n\n![alt](later.png)\n")
+        self.assertEqual(md.first, {"summary": "Some *text* &amp; <b>more</b>", "thumbnail": "raw.png"})
+        self.assertEqual(md.first, extract_meta(html))
+
+    def test26_metadb(self):
+        p = dict(params, input_path="./test", output_path="_site/metadb", cache_path="_site/metadb-cache")
+        build(p, from_scratch=True)
+        # the manifest only has the outputs, the source files are in the db
+        manifest = load_manifest(p["output_path"], p["cache_path"])
+        self.assertEqual(manifest["outputs"].keys(), p["_manifest"]["outputs"].keys())
+        self.assertEqual(manifest["outputs"][os.path.join("_site", "metadb", "bla.html")].keys(), {"key"})
+        for section in ("sources", "images", "meta"):
+            for path, rec in p["_manifest"][section].items():
+                self.assertEqual(manifest[section].get(path), rec)
+        self.assertEqual(manifest["meta"].get("./test/testdir/test.md")[1]["title"], "My Document")
+        self.assertIsNone(manifest["images"].get("./test/bla.md"))
+        # the files of other content dirs sharing the cache dir are kept
+        store = appie.MetaStore(os.path.join(p["cache_path"], appie.METADB_NAME))
+        with store.db() as db:
+            db.execute("INSERT OR REPLACE INTO files (path, mtime, size, hash) VALUES (?, 1, 1, 'x')",
+                       (os.path.join("content", "other.md"),))
+        # a build without the manifest in memory reads the meta data from the db
+        del p["_manifest"]
+        build(p)
+        self.assertEqual(p["_manifest"]["meta"]["./test/testdir/test.md"][1]["title"], "My Document")
+        self.assertIsNotNone(store.row(os.path.join("content", "other.md")))
+        # the meta data saved by a build with other params isn't restored
+        file = walk_directory("./test", **p)["testdir"]["test.md"]
+        key = appie.page_key(file, appie.page_template(file), **p)
+        rec = p["_manifest"]["meta"]["./test/testdir/test.md"]
+        p["_manifest"]["meta"]["./test/testdir/test.md"] = [rec[0], dict(rec[1], title="Other"), "other"]
+        self.assertFalse(appie.restore_page(file, key, **dict(p, _newmanifest=new_manifest())))
+        self.assertNotEqual(file.get("title"), "Other")
+
 if __name__ == '__main__':
     unittest.main()
 